@@ -1,89 +1,165 @@
-import json
+import threading
 from pathlib import Path
 from utils import (create_archive, upload_archive_to_r2,
-                   create_pdf_archive, upload_pdf_archive_to_r2)
+                   create_pdf_archive, upload_pdf_archive_to_r2,
+                   stream_archive_to_r2, stream_pdf_archive_to_r2,
+                   get_upload_executor)
+from events import start_events, follow_events
+from metadata import get_metadata
+import metrics
 
 raw_dir = Path('data/raw')
 
-def archive_pages():
-    for ldir in raw_dir.glob('*/*/*/'):
-        if not ldir.is_dir():
-            continue
-        list_file = ldir.parent.parent / 'constituency_list.json'
-        
-        parts_file = ldir.parent / 'parts.json'
-        parts = json.loads(parts_file.read_text())
-        part_files = []
-        for part_info in parts:
-            pno = part_info['partNumber']
-            pfiles = [ ldir / f'{pno}.pdf', ldir / f'f{pno}.pdf', ldir / f'd{pno}.pdf' ]
-            pfile_selected = None
-            for pfile in pfiles:
-                if pfile.exists():
-                    pfile_selected = pfile
-                    break
-            part_files.append(pfile_selected)
-        all_parts_done = all([ p is not None and p.stat().st_size <= 4 for p in part_files ])
-        if not all_parts_done:
-            continue
-        acno = ldir.parent.name
-    
-        curr_cinfo = None
-        cinfos = json.loads(list_file.read_text())
-        for cinfo in cinfos:
-            if cinfo['asmblyNo'] == int(acno):
-                curr_cinfo = cinfo
+# event that marks a part as ready for each kind of archive
+ready_events = { 'pages': 'converted', 'pdfs': 'downloaded' }
+
+def get_part_files(ldir, parts):
+    part_files = []
+    for part_info in parts:
+        pno = part_info['partNumber']
+        pfiles = [ ldir / f'{pno}.pdf', ldir / f'f{pno}.pdf', ldir / f'd{pno}.pdf' ]
+        pfile_selected = None
+        for pfile in pfiles:
+            if pfile.exists():
+                pfile_selected = pfile
                 break
-    
-        print(f'archiving {ldir}')
-        scode = curr_cinfo['stateCd']
-        acno  = curr_cinfo['asmblyNo']
-        create_archive(scode, acno, ldir.name)
-        upload_archive_to_r2(scode, acno, ldir.name)
+        part_files.append(pfile_selected)
+    return part_files
 
+def is_part_ready(kind, p):
+    if p is None:
+        return False
+    sz = p.stat().st_size
+    if kind == 'pages':
+        return sz <= 4
+    return sz > 4 or sz == 0
 
-def archive_pdfs():
+def get_part_number(pdf_file):
+    return int(pdf_file.name[:-4].lstrip('df'))
+
+def get_ldir_parts(ldir):
+    return get_metadata().get_parts(ldir.parent.parent.name, ldir.parent.name)
+
+def archive_dir(ldir, kind, stream):
+    curr_cinfo = get_metadata().get_constituency(ldir.parent.parent.name, ldir.parent.name)
+
+    print(f'archiving {ldir}')
+    scode = curr_cinfo['stateCd']
+    acno  = curr_cinfo['asmblyNo']
+    if kind == 'pages':
+        if stream:
+            # pick up a tar left behind by an earlier non streaming run first
+            upload_archive_to_r2(scode, acno, ldir.name)
+            stream_archive_to_r2(scode, acno, ldir.name)
+        else:
+            create_archive(scode, acno, ldir.name)
+            upload_archive_to_r2(scode, acno, ldir.name)
+    else:
+        if stream:
+            upload_pdf_archive_to_r2(scode, acno, ldir.name)
+            stream_pdf_archive_to_r2(scode, acno, ldir.name)
+        else:
+            create_pdf_archive(scode, acno, ldir.name)
+            upload_pdf_archive_to_r2(scode, acno, ldir.name)
+
+def archive_all(kind, stream):
+    futures = []
     for ldir in raw_dir.glob('*/*/*/'):
         if not ldir.is_dir():
             continue
-        list_file = ldir.parent.parent / 'constituency_list.json'
-        
-        parts_file = ldir.parent / 'parts.json'
-        parts = json.loads(parts_file.read_text())
-        part_files = []
-        for part_info in parts:
-            pno = part_info['partNumber']
-            pfiles = [ ldir / f'{pno}.pdf', ldir / f'f{pno}.pdf', ldir / f'd{pno}.pdf' ]
-            pfile_selected = None
-            for pfile in pfiles:
-                if pfile.exists():
-                    pfile_selected = pfile
-                    break
-            part_files.append(pfile_selected)
-
-        all_parts_done = all([ p is not None and (p.stat().st_size > 4 or p.stat().st_size == 0) for p in part_files ])
+        parts = get_ldir_parts(ldir)
+        part_files = get_part_files(ldir, parts)
+        all_parts_done = all([ is_part_ready(kind, p) for p in part_files ])
         if not all_parts_done:
             continue
+        futures.append(get_upload_executor().submit(archive_dir, ldir, kind, stream))
+    for future in futures:
+        future.result()
 
-        acno = ldir.parent.name
-    
-        curr_cinfo = None
-        cinfos = json.loads(list_file.read_text())
-        for cinfo in cinfos:
-            if cinfo['asmblyNo'] == int(acno):
-                curr_cinfo = cinfo
-                break
-    
-        print(f'archiving {ldir}')
-        scode = curr_cinfo['stateCd']
-        acno  = curr_cinfo['asmblyNo']
-        create_pdf_archive(scode, acno, ldir.name)
-        upload_pdf_archive_to_r2(scode, acno, ldir.name)
+
+def archive_pages(stream=False):
+    archive_all('pages', stream)
+
+
+def archive_pdfs(stream=False):
+    archive_all('pdfs', stream)
+
+
+class IncrementalArchiver:
+    # keeps the parts still missing for each language directory it has heard
+    # about, a directory is archived as soon as its last part is reported
+    def __init__(self, kind, stream):
+        self.kind = kind
+        self.stream = stream
+        self.remaining = {}
+        # directories handed to the upload executor and not finished yet
+        self.archiving = set()
+        self.failures = []
+        self.lock = threading.Lock()
+
+    def load_remaining(self, ldir):
+        parts = get_ldir_parts(ldir)
+        part_files = get_part_files(ldir, parts)
+        return set([ part_info['partNumber'] for part_info, p in zip(parts, part_files)
+                     if not is_part_ready(self.kind, p) ])
+
+    def archive_done(self, ldir, future):
+        with self.lock:
+            self.archiving.discard(ldir)
+            if future.exception() is not None:
+                print(f'ERROR: archiving {ldir} failed - {future.exception()}')
+                self.failures.append(future.exception())
+
+    def part_ready(self, pdf_file):
+        ldir = pdf_file.parent
+        with self.lock:
+            if ldir in self.archiving:
+                return
+        if not ldir.is_dir():
+            # archived already
+            self.remaining.pop(ldir, None)
+            return
+        if ldir not in self.remaining:
+            self.remaining[ldir] = self.load_remaining(ldir)
+        else:
+            self.remaining[ldir].discard(get_part_number(pdf_file))
+
+        if len(self.remaining[ldir]) != 0:
+            return
+        del self.remaining[ldir]
+        with self.lock:
+            self.archiving.add(ldir)
+        future = get_upload_executor().submit(archive_dir, ldir, self.kind, self.stream)
+        future.add_done_callback(lambda f: self.archive_done(ldir, f))
+
+    def run(self):
+        segment = start_events(self.kind)
+        # one full pass for whatever finished while nobody was watching
+        archive_all(self.kind, self.stream)
+        for event_kind, pdf_file in follow_events(segment, self.kind):
+            with self.lock:
+                if len(self.failures) > 0:
+                    raise self.failures[0]
+            if event_kind != ready_events[self.kind]:
+                continue
+            self.part_ready(pdf_file)
 
 
 if __name__ == '__main__':
-    import sys
-    if sys.argv[1] == 'pages':
-        archive_pages()
-    elif sys.argv[1] == 'pdfs':
-        archive_pdfs()
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['pages', 'pdfs', 'watch'])
+    parser.add_argument('kind', nargs='?', choices=['pages', 'pdfs'],
+                        help='what to archive in watch mode')
+    parser.add_argument('--stream', action='store_true')
+    metrics.add_metrics_args(parser)
+    args = parser.parse_args()
+    if args.command == 'watch' and args.kind is None:
+        parser.error('watch needs the kind of archive to build, pages or pdfs')
+    metrics.start_metrics(args)
+    if args.command == 'watch':
+        IncrementalArchiver(args.kind, args.stream).run()
+    elif args.command == 'pages':
+        archive_pages(args.stream)
+    elif args.command == 'pdfs':
+        archive_pdfs(args.stream)
@@ -0,0 +1,114 @@
+import json
+import time
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+from annotate import get_truth, data_dir
+from solve import solve_captcha_with_confidence, is_confident
+
+stages = [ 'threshold', 'remove_lines', 'dilate_and_erode', 'split_img', 'ocr' ]
+
+
+def run_batch(arg):
+    backend, min_confidence, items = arg
+    results = []
+    for k,v in items:
+        img = Image.open(data_dir / f'{k}.png')
+        img.load()
+        timings = {}
+        start = time.perf_counter()
+        solution = solve_captcha_with_confidence(img, backend, timings)
+        timings['total'] = time.perf_counter() - start
+        results.append((k, v, solution.text, is_confident(solution, min_confidence), timings))
+    return results
+
+
+def latency_stats(values):
+    values = np.array(values) * 1000
+    return {
+        'p50_ms'  : float(np.percentile(values, 50)),
+        'p95_ms'  : float(np.percentile(values, 95)),
+        'p99_ms'  : float(np.percentile(values, 99)),
+        'mean_ms' : float(values.mean()),
+    }
+
+
+def summarize(results, backend, procs, wall_secs):
+    count = len(results)
+    success = 0
+    accepted = 0
+    accepted_success = 0
+    length_mismatches = 0
+    confusion = {}
+    stage_times = { s:[] for s in stages + ['total'] }
+    for k, v, val, confident, timings in results:
+        for stage, secs in timings.items():
+            stage_times[stage].append(secs)
+        if v == val:
+            success += 1
+        if confident:
+            accepted += 1
+            if v == val:
+                accepted_success += 1
+        if len(v) != len(val):
+            length_mismatches += 1
+            continue
+        for tc, pc in zip(v, val):
+            row = confusion.setdefault(tc, {})
+            row[pc] = row.get(pc, 0) + 1
+
+    return {
+        'backend'           : backend,
+        'procs'             : procs,
+        'count'             : count,
+        'wall_secs'         : wall_secs,
+        'throughput'        : count / wall_secs,
+        'accuracy'          : success / count,
+        # the download loop only posts solves that pass the confidence gate
+        'accepted'          : accepted / count,
+        'accepted_accuracy' : accepted_success / accepted if accepted > 0 else 0,
+        'length_mismatches' : length_mismatches,
+        'stages'            : { s:latency_stats(t) for s,t in stage_times.items() if len(t) > 0 },
+        'confusion'         : confusion,
+        'failures'          : [ [k, v, val, confident] for k, v, val, confident, _ in results if v != val ],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=['tesseract', 'knn'], default='tesseract')
+    parser.add_argument('--procs', type=int, default=1)
+    parser.add_argument('--limit', type=int, default=0)
+    parser.add_argument('--out', default='bench.json')
+    parser.add_argument('--min-confidence', type=float, default=0.5,
+                        help='confidence gate to evaluate, for tuning --min-captcha-confidence of the scrapers')
+    args = parser.parse_args()
+
+    items = list(get_truth().items())
+    if args.limit > 0:
+        items = items[:args.limit]
+    if len(items) == 0:
+        raise Exception('no annotated captchas found')
+
+    batches = [ (args.backend, args.min_confidence, items[i::args.procs]) for i in range(args.procs) ]
+    start = time.perf_counter()
+    if args.procs == 1:
+        batch_results = [ run_batch(batches[0]) ]
+    else:
+        with Pool(args.procs) as pool:
+            batch_results = pool.map(run_batch, batches)
+    wall_secs = time.perf_counter() - start
+
+    results = [ r for batch in batch_results for r in batch ]
+    summary = summarize(results, args.backend, args.procs, wall_secs)
+    with open(args.out, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    print(f'{summary["count"]} captchas, accuracy: {summary["accuracy"]:.3f}, throughput: {summary["throughput"]:.1f}/sec')
+    print(f'accepted: {summary["accepted"]:.3f}, accuracy of accepted: {summary["accepted_accuracy"]:.3f}')
+    for stage, stats in summary['stages'].items():
+        print(f'{stage:>16}: p50 {stats["p50_ms"]:.2f}ms p95 {stats["p95_ms"]:.2f}ms p99 {stats["p99_ms"]:.2f}ms')
+    print(f'results written to {args.out}')
@@ -1,50 +1,46 @@
+import io
+import time
+import functools
+import threading
 from pathlib import Path
+from collections import namedtuple
 
 import cv2
 from imgcat import imgcat
 from PIL import Image, ImageOps
 import numpy as np
 import pytesseract
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
 tessdir = Path(__file__).parent / 'models'
 olddir  = tessdir / 'old'
 newdir  = tessdir / 'lstm'
 
 def thresholding(img, lower, upper):
-    bw = np.asarray(img).copy()
-    bw[bw < lower] = 0    # Black
-    bw[bw >= upper] = 255 # White
-    return Image.fromarray(bw)
+    # same two step assignment as before, just done once on a lookup table
+    lut = np.arange(256, dtype=np.uint8)
+    lut[lut < lower] = 0    # Black
+    lut[lut >= upper] = 255 # White
+    return Image.fromarray(lut[np.asarray(img)])
 
 def median_blur_row(arr, r):
-    h,w = arr.shape
-    for c in range(w):
-        above = arr[r-1,c]
-        below = arr[r+1,c]
-        if above == 0 or below == 0:
-            arr[r,c] = 0
-        else:
-            arr[r,c] = 255
+    arr[r] = np.where((arr[r-1] == 0) | (arr[r+1] == 0), 0, 255)
 
-def median_blur_diag(arr):
-    h,w = arr.shape
+@functools.lru_cache(maxsize=16)
+def diag_path(h, w):
+    # pixels visited by the diagonal line filter, bottom left to top right
+    rows = []
+    cols = []
     c = 2
     step = 2
     r = h - 1
     while r > 0:
         for i in range(step):
-            bcount = 0
-            wcount = 0
-            for r1, c1 in [(r-1,c),(r+1,c),(r,c),
-                           (r-1,c-1),(r,c-1),(r+1,c-1),
-                           (r-1,c+1),(r,c+1),(r+1,c+1)]:
-                v = 255 if (r1 < 0 or c1 < 0 or r1 > h-1 or c1 > w-1) else arr[r1,c1]
-                if v == 255:
-                    wcount += 1
-                else:
-                    bcount += 1
-            
-            arr[r,c] = 0 if bcount > wcount else 255
+            rows.append(r)
+            cols.append(c)
             c += 1
 
         if step == 2:
@@ -53,6 +49,32 @@ def median_blur_diag(arr):
             step = 2
 
         r -= 1
+    return np.array(rows), np.array(cols)
+
+def median_blur_diag(arr):
+    # 3x3 majority filter along the diagonal path, applied in place. The only
+    # already updated pixel in a neighbourhood is the previous one on the path,
+    # so count the other 8 from the original image and resolve the ties
+    # ( 4 black of 8 ) by carrying the previous result forward
+    h,w = arr.shape
+    rows, cols = diag_path(h, w)
+    if len(rows) == 0:
+        return
+    black = np.pad(arr != 255, 1, constant_values=False)
+    counts = np.zeros(len(rows), dtype=np.int32)
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            counts += black[rows + 1 + dr, cols + 1 + dc]
+    counts[1:] -= black[rows[:-1] + 1, cols[:-1] + 1]
+
+    decided = counts != 4
+    decided[0] = True
+    is_black = counts > 4
+    is_black[0] = counts[0] > 4
+    last_decided = np.maximum.accumulate(np.where(decided, np.arange(len(rows)), 0))
+    is_black = is_black[last_decided]
+
+    arr[rows, cols] = np.where(is_black, 0, 255)
 
 
 def join(split1, split2, h,w):
@@ -136,9 +158,11 @@ def remove_lines(arr):
     median_blur_row(arr, 50)
 
 def invert(arr):
-    arr[arr == 255] = 1
-    arr[arr == 0] = 255
-    arr[arr == 1] = 0
+    lut = np.arange(256, dtype=np.uint8)
+    lut[lut == 255] = 1
+    lut[lut == 0] = 255
+    lut[lut == 1] = 0
+    arr[...] = lut[arr]
 
 def dilate_and_erode(arr):
     kernel = np.ones((3, 3), np.uint8)
@@ -147,17 +171,19 @@ def dilate_and_erode(arr):
     return arr
 
 expected_chars = 'abcdefghijklmnopqrstuvwxyz0123456789'
-def clean_text(text, expect_single_char):
-    text = text.strip().lower()
+def clean_symbols(symbols, expect_single_char):
+    # symbols is a list of (text, confidence) as recognized, characters outside
+    # expected_chars are dropped along with their confidences
     out = ''
-    for c in text:
-        if c in expected_chars:
-            out += c
-    if out == '':
-        return out
+    confidences = []
+    for c, conf in symbols:
+        for ch in c.strip().lower():
+            if ch in expected_chars:
+                out += ch
+                confidences.append(conf)
     if expect_single_char:
-        return out[0]
-    return out
+        return out[:1], confidences[:1]
+    return out, confidences
     
 def correct_text(txt, area, ch, cw):
     if txt == '0' and area < 500:
@@ -181,24 +207,210 @@ def correct_text(txt, area, ch, cw):
 
     return txt
 
-def solve_captcha(img):
+class PytesseractOCR:
+    # forks a tesseract process per glyph, only used when tesserocr is missing,
+    # the cli only reports word level confidences so each character of a word
+    # gets its word's
+    def recognize(self, glyphs):
+        results = []
+        for c_img, psm in glyphs:
+            config_base = ' --oem {} --psm {} --tessdata-dir "{}" configfile myconfig'
+            config_old = config_base.format(0, psm, str(olddir))
+            data = pytesseract.image_to_data(c_img, config=config_old,
+                                             output_type=pytesseract.Output.DICT)
+            symbols = []
+            for t, c in zip(data['text'], data['conf']):
+                t = str(t).strip()
+                symbols.extend([ (ch, float(c) / 100) for ch in t ])
+            results.append(symbols)
+        return results
+
+
+class TesserocrOCR:
+    # keeps the legacy engine and its traineddata loaded in process
+    def __init__(self):
+        self.api = tesserocr.PyTessBaseAPI(path=f'{olddir}/', lang='eng',
+                                           oem=tesserocr.OEM.TESSERACT_ONLY,
+                                           configs=[str(olddir / 'myconfig')])
+
+    def recognize(self, glyphs):
+        # one (character, confidence) pair per symbol tesseract found
+        results = []
+        level = tesserocr.RIL.SYMBOL
+        for c_img, psm in glyphs:
+            self.api.SetPageSegMode(psm)
+            self.api.SetImage(c_img)
+            self.api.Recognize()
+            symbols = []
+            ri = self.api.GetIterator()
+            if ri is not None:
+                for symbol in tesserocr.iterate_level(ri, level):
+                    text = symbol.GetUTF8Text(level)
+                    if text is None:
+                        continue
+                    symbols.append((text, symbol.Confidence(level) / 100))
+            results.append(symbols)
+        return results
+
+
+ocr_local = threading.local()
+
+def get_ocr():
+    # tesseract api handles can't be shared across threads
+    ocr = getattr(ocr_local, 'ocr', None)
+    if ocr is None:
+        if tesserocr is not None:
+            ocr = TesserocrOCR()
+        else:
+            ocr = PytesseractOCR()
+        ocr_local.ocr = ocr
+    return ocr
+
+
+glyph_size = 16
+knn_k = 3
+knn_model_file = tessdir / 'glyphs.npz'
+
+def normalize_glyph(c_arr):
+    # pad to a centered square and shrink to a fixed size bitmap
+    ch,cw = c_arr.shape
+    side = max(ch, cw)
+    square = np.zeros((side, side), dtype=np.uint8)
+    y = (side - ch) // 2
+    x = (side - cw) // 2
+    square[y:y+ch, x:x+cw] = c_arr
+    small = cv2.resize(square, (glyph_size, glyph_size), interpolation=cv2.INTER_AREA)
+    return (small > 127).reshape(-1)
+
+def crop_to_content(c_arr):
+    ys, xs = np.nonzero(c_arr)
+    if len(ys) == 0:
+        return c_arr
+    return c_arr[ys.min():ys.max()+1, xs.min():xs.max()+1]
+
+def split_wide_glyph(c_arr, char_width):
+    # components with touching characters are cut into equal width slices
+    ch,cw = c_arr.shape
+    count = max(1, int(round(cw / char_width)))
+    bounds = np.linspace(0, cw, count + 1).astype(int)
+    return [ crop_to_content(c_arr[:, bounds[i]:bounds[i+1]]) for i in range(count) ]
+
+
+class KnnClassifier:
+    def __init__(self, model_file):
+        model = np.load(model_file)
+        self.glyphs = model['glyphs'].astype(bool)
+        self.labels = model['labels']
+        self.char_width = float(model['char_width'])
+
+    def classify(self, c_arr):
+        glyph = normalize_glyph(c_arr)
+        dists = np.count_nonzero(self.glyphs != glyph, axis=1)
+        nearest = np.argsort(dists, kind='stable')[:knn_k]
+        votes = {}
+        for idx in nearest:
+            label = str(self.labels[idx])
+            votes[label] = votes.get(label, 0) + 1
+        # most votes wins, ties go to whichever label is nearest
+        label = max(votes, key=lambda label: votes[label])
+        nearest_dist = min([ dists[idx] for idx in nearest if str(self.labels[idx]) == label ])
+        similarity = 1 - nearest_dist / len(glyph)
+        return label, similarity * votes[label] / len(nearest)
+
+    def recognize(self, splits):
+        text = ''
+        confidences = []
+        for c_arr,loc in splits:
+            ch,cw = c_arr.shape
+            area = ch*cw
+            if area < 1000:
+                pieces = [ c_arr ]
+            else:
+                pieces = split_wide_glyph(c_arr, self.char_width)
+            for piece in pieces:
+                label, conf = self.classify(piece)
+                text += label
+                confidences.append(conf)
+        return text, confidences
+
+
+@functools.lru_cache(maxsize=4)
+def get_knn_classifier(model_file=knn_model_file):
+    return KnnClassifier(model_file)
+
+
+def record_timing(timings, stage, start):
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = now - start
+    return now
+
+
+def preprocess(img, timings=None):
+    start = time.perf_counter()
     img = img.convert('L')
 
     img = thresholding(img, 128, 128)
 
     arr = np.asarray(img).copy()
+    start = record_timing(timings, 'threshold', start)
 
     remove_lines(arr)
     invert(arr)
+    start = record_timing(timings, 'remove_lines', start)
+
     arr = dilate_and_erode(arr)
+    record_timing(timings, 'dilate_and_erode', start)
+    return arr
+
+
+CaptchaSolution = namedtuple('CaptchaSolution', ['text', 'confidences', 'expected_length'])
+
+def estimate_length(splits, char_width=None):
+    # number of characters the segmentation implies, wide components are
+    # measured against the width of the single character ones
+    widths = [ c_arr.shape[1] for c_arr,loc in splits if c_arr.size < 1000 ]
+    if char_width is None and len(widths) > 0:
+        char_width = float(np.median(widths))
+    count = 0
+    for c_arr,loc in splits:
+        if c_arr.size < 1000:
+            count += 1
+        elif char_width is None:
+            return None
+        else:
+            count += max(1, int(round(c_arr.shape[1] / char_width)))
+    return count
+
+def is_confident(solution, min_confidence):
+    # empty and wrong length solves are never accepted, a min_confidence
+    # of 0 leaves just those checks
+    if solution.text == '':
+        return False
+    if solution.expected_length is not None and len(solution.text) != solution.expected_length:
+        return False
+    if min_confidence <= 0:
+        return True
+    return min(solution.confidences) >= min_confidence
+
 
-    img = Image.fromarray(arr)
-    #imgcat(img)
+def solve_captcha_with_confidence(img, backend='tesseract', timings=None):
+    arr = preprocess(img, timings)
 
+    #imgcat(Image.fromarray(arr))
 
+    start = time.perf_counter()
     splits = split_img(arr)
+    start = record_timing(timings, 'split_img', start)
 
-    text = ''
+    if backend == 'knn':
+        classifier = get_knn_classifier()
+        text, confidences = classifier.recognize(splits)
+        record_timing(timings, 'ocr', start)
+        return CaptchaSolution(text, confidences, estimate_length(splits, classifier.char_width))
+
+    glyphs = []
+    glyph_infos = []
     for c_arr,loc in splits:
         x,y = loc
         ch,cw = c_arr.shape
@@ -219,13 +431,26 @@ def solve_captcha(img):
         #imgcat(c_img)
 
         psm = 10 if expect_single_char else 8
-        config_base = ' --oem {} --psm {} --tessdata-dir "{}" configfile myconfig'
-        config_old = config_base.format(0, psm, str(olddir))
-        config_new = config_base.format(1, psm, str(newdir))
-        ctext = pytesseract.image_to_string(c_img, config=config_old)
-        #print(ctext)
-        ctext = clean_text(ctext, expect_single_char)
+        glyphs.append((c_img, psm))
+        glyph_infos.append((expect_single_char, area, ch, cw))
+
+    results = get_ocr().recognize(glyphs)
+
+    text = ''
+    confidences = []
+    for symbols, (expect_single_char, area, ch, cw) in zip(results, glyph_infos):
+        ctext, cconfs = clean_symbols(symbols, expect_single_char)
+        # corrections only ever swap one character for another
         ctext = correct_text(ctext, area, ch, cw)
         #print(ctext)
         text += ctext
-    return text
+        confidences.extend(cconfs)
+    record_timing(timings, 'ocr', start)
+    return CaptchaSolution(text, confidences, estimate_length(splits))
+
+def solve_captcha(img, backend='tesseract', timings=None):
+    return solve_captcha_with_confidence(img, backend, timings).text
+
+def solve_captcha_bytes(img_bytes, backend='tesseract'):
+    img = Image.open(io.BytesIO(img_bytes))
+    return solve_captcha_with_confidence(img, backend)
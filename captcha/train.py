@@ -0,0 +1,40 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from annotate import get_truth, data_dir
+from solve import preprocess, split_img, normalize_glyph, knn_model_file
+
+
+if __name__ == '__main__':
+    model_file = Path(sys.argv[1]) if len(sys.argv) > 1 else knn_model_file
+    truth = get_truth()
+    glyphs = []
+    labels = []
+    widths = []
+    skipped = 0
+    for k,v in truth.items():
+        file = data_dir / f'{k}.png'
+        arr = preprocess(Image.open(file))
+        splits = split_img(arr)
+        # only captchas where every component is a single character can be labelled
+        if len(splits) != len(v):
+            skipped += 1
+            continue
+        for (c_arr, loc), c in zip(splits, v):
+            glyphs.append(normalize_glyph(c_arr))
+            labels.append(c)
+            widths.append(c_arr.shape[1])
+
+    if len(glyphs) == 0:
+        raise Exception('no usable captchas found in the truth set')
+
+    model_file.parent.mkdir(exist_ok=True, parents=True)
+    np.savez_compressed(model_file,
+                        glyphs=np.array(glyphs, dtype=np.uint8),
+                        labels=np.array(labels),
+                        char_width=np.median(widths))
+    print(f'trained on {len(glyphs)} glyphs from {len(truth) - skipped} captchas, skipped {skipped}')
+    print(f'model written to {model_file}')
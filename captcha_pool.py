@@ -0,0 +1,57 @@
+import time
+import queue
+import threading
+
+fill_error_delay = 1
+
+
+class CaptchaPool:
+    # keeps solved captchas ready so that downloads don't wait on the captcha
+    # fetch and ocr, fetch_fn runs on the filler threads and returns a
+    # (captcha_id, value) pair or None when the captcha should be skipped
+    def __init__(self, fetch_fn, size, ttl, num_threads):
+        self.fetch_fn = fetch_fn
+        self.ttl = ttl
+        self.q = queue.Queue(maxsize=size)
+        self.stop_event = threading.Event()
+        self.threads = [ threading.Thread(target=self.fill, daemon=True) for i in range(num_threads) ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def is_stale(self, fetched_at):
+        return time.monotonic() - fetched_at > self.ttl
+
+    def fill(self):
+        while not self.stop_event.is_set():
+            try:
+                entry = self.fetch_fn()
+            except Exception as ex:
+                print(f'\t\t\tWARNING: captcha pool fetch failed - {ex}')
+                self.stop_event.wait(fill_error_delay)
+                continue
+            if entry is None:
+                continue
+
+            captcha_id, value = entry
+            item = (time.monotonic(), captcha_id, value)
+            while not self.stop_event.is_set() and not self.is_stale(item[0]):
+                try:
+                    self.q.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    def take(self, timeout=None):
+        # raises queue.Empty when nothing fresh shows up in time
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            fetched_at, captcha_id, value = self.q.get(timeout=remaining)
+            if self.is_stale(fetched_at):
+                continue
+            return captcha_id, value
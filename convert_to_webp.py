@@ -1,7 +1,11 @@
 from pathlib import Path
-from utils import convert_to_pages
+from utils import convert_to_pages, add_webp_args
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    add_webp_args(parser)
+    args = parser.parse_args()
     for p in Path('data/raw/').glob('*/*/*/*.pdf'):
         print(f'converting file {p}')
-        convert_to_pages(p)
+        convert_to_pages(p, encoder=args.webp_encoder, level=args.webp_level)
@@ -0,0 +1,114 @@
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class Coordinator:
+    # shared queue of (state, AC, lang) jobs that scraper boxes lease one at a
+    # time, a lease that is not renewed within lease_timeout goes back to the
+    # queue, so a dead or stuck box only delays its current job
+    def __init__(self, path, lease_timeout=600):
+        path = Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.lease_timeout = lease_timeout
+        self.lock = threading.Lock()
+        # the file is meant to sit on storage shared between boxes, where the
+        # shared memory WAL needs does not work, so the default rollback
+        # journal is kept and every write takes the lock up front
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                              'scode TEXT, acno TEXT, lang TEXT, '
+                              "state TEXT DEFAULT 'pending', worker TEXT, lease_expires REAL, "
+                              'attempts INTEGER DEFAULT 0, updated_at REAL, '
+                              'PRIMARY KEY (scode, acno, lang))')
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def write(self, sql, params=()):
+        with self.transaction() as conn:
+            return conn.execute(sql, params).rowcount
+
+    def seed(self, jobs):
+        # jobs are handed out in the order they were first seeded, seeding
+        # again is harmless
+        now = time.time()
+        rows = [ (str(scode), str(acno), lang, now) for scode, acno, lang in jobs ]
+        with self.transaction() as conn:
+            conn.executemany('INSERT OR IGNORE INTO jobs (scode, acno, lang, updated_at) '
+                             'VALUES (?, ?, ?, ?)', rows)
+
+    def claim(self, worker):
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute("SELECT scode, acno, lang FROM jobs "
+                               "WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+                               "ORDER BY rowid LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, "
+                             "attempts = attempts + 1, updated_at = ? "
+                             "WHERE scode = ? AND acno = ? AND lang = ?",
+                             (worker, now + self.lease_timeout, now) + tuple(row))
+        return None if row is None else tuple(row)
+
+    def heartbeat(self, job, worker):
+        # False once the lease has been lost to another worker
+        now = time.time()
+        count = self.write("UPDATE jobs SET lease_expires = ?, updated_at = ? "
+                           "WHERE scode = ? AND acno = ? AND lang = ? AND state = 'leased' AND worker = ?",
+                           (now + self.lease_timeout, now) + tuple(job) + (worker,))
+        return count == 1
+
+    def complete(self, job, worker):
+        # the work is done even if the lease was lost on the way
+        self.write("UPDATE jobs SET state = 'done', worker = ?, lease_expires = NULL, updated_at = ? "
+                   "WHERE scode = ? AND acno = ? AND lang = ?",
+                   (worker, time.time()) + tuple(job))
+
+    def release(self, job, worker):
+        self.write("UPDATE jobs SET state = 'pending', worker = NULL, lease_expires = NULL, updated_at = ? "
+                   "WHERE scode = ? AND acno = ? AND lang = ? AND state = 'leased' AND worker = ?",
+                   (time.time(),) + tuple(job) + (worker,))
+
+    def get_counts(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        return dict(rows)
+
+
+class LeaseKeeper:
+    # renews a job's lease from a background thread while it is being worked on
+    def __init__(self, coordinator, job, worker):
+        self.coordinator = coordinator
+        self.job = job
+        self.worker = worker
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        interval = self.coordinator.lease_timeout / 3
+        while not self.stop_event.wait(interval):
+            try:
+                if not self.coordinator.heartbeat(self.job, self.worker):
+                    print(f'WARNING: lost the lease on {self.job}, another worker may be handling it too')
+            except sqlite3.Error as ex:
+                print(f'WARNING: unable to renew the lease on {self.job} - {ex}')
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop_event.set()
+        self.thread.join()
@@ -1,12 +1,22 @@
+import threading
 from pathlib import Path
 
-from boto3.s3.transfer import TransferConfig
-from utils import (get_boto_client, download_pdf_archive_from_r2,
-                   extract_archive, convert_to_pages,
+from utils import (get_boto_client, stream_pdf_archive_from_r2,
+                   convert_to_pages, add_webp_args, webp_encoder, webp_lossless_level,
                    create_archive, upload_archive_to_r2)
+from manifest import get_manifest
+from pipeline import Stage, Pipeline
+import metrics
 
-import threading
-import queue
+bucket_name_from = 'indian-electoral-rolls-pdfs'
+# manifest tag for the sources this script converted and uploaded itself, a
+# pages archive in the bucket may come from the scraper and an older roll,
+# so it is no reason to delete a source unconverted
+reprocessed_tag = 'reprocessed:indian-electoral-rolls-pdfs'
+checkpoint_file = Path('data/reprocess_done.txt')
+
+num_procs = 32
+webp_level = webp_lossless_level
 
 def get_details(key):
     parts = key.split('/')
@@ -16,43 +26,134 @@ def get_details(key):
     return scode, acno, lang
 
 
-q = queue.Queue(maxsize=3)
+class KeyTracker:
+    # counts the pdfs of an archive still being converted, the download
+    # itself holds one count until the whole archive has been read
+    def __init__(self, key):
+        self.key = key
+        self.remaining = 1
+        self.lock = threading.Lock()
 
-def run_conversion():
-    while True:
-        key = q.get()
-        if key == 'DONE':
-            q.task_done()
-            break
-        print(f'processing {key} for conversion')
-        scode, acno, lang = get_details(key)
-        extract_archive(scode, acno, lang)
-        for p in Path(f'data/raw/{key[:-4]}/').glob('*.pdf'):
-            print(f'converting file {p}')
-            convert_to_pages(p, num_procs=32)
+    def add(self):
+        with self.lock:
+            self.remaining += 1
 
-        create_archive(scode, acno, lang)
-        upload_archive_to_r2(scode, acno, lang)
-        s3.delete_object(Bucket=bucket_name_from, Key=key)
-        q.task_done()
+    def done(self):
+        with self.lock:
+            self.remaining -= 1
+            return self.remaining == 0
 
 
-s3 = get_boto_client()
+def import_checkpoint():
+    # keys recorded by runs that still kept a plain text checkpoint
+    if not checkpoint_file.exists():
+        return
+    manifest = get_manifest()
+    for line in checkpoint_file.read_text().split('\n'):
+        if line.strip() != '':
+            manifest.mark_done(reprocessed_tag, *get_details(line.strip()), None)
+    checkpoint_file.unlink()
 
-bucket_name_from = 'indian-electoral-rolls-pdfs'
 
-threading.Thread(target=run_conversion, daemon=True).start()
-threading.Thread(target=run_conversion, daemon=True).start()
+def list_keys():
+    s3 = get_boto_client()
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name_from):
+        for item in page.get('Contents', []):
+            key = item['Key']
+            if not key.endswith('.tar'):
+                continue
+            if key == 'raw.tar':
+                continue
+            yield key
+
+
+def download(key):
+    print(f'processing {key} for conversion')
+    scode, acno, lang = get_details(key)
+    tracker = KeyTracker(key)
+    queued = set()
+
+    def on_pdf(p):
+        queued.add(p)
+        tracker.add()
+        convert_stage.put((tracker, p))
+
+    stream_pdf_archive_from_r2(scode, acno, lang, on_pdf)
+
+    # pdfs extracted by an interrupted run, already converted ones are skipped
+    for p in Path(f'data/raw/{key[:-4]}/').glob('*.pdf'):
+        if p not in queued:
+            on_pdf(p)
+
+    if tracker.done():
+        return key
+    return None
 
-response = s3.list_objects(Bucket=bucket_name_from)
-for item in response['Contents']:
-    key = item['Key']
-    if not key.endswith('.tar'):
-        continue
-    if key == 'raw.tar':
-        continue
+
+def convert(item):
+    tracker, p = item
+    print(f'converting file {p}')
+    convert_to_pages(p, num_procs=num_procs, encoder=webp_encoder, level=webp_level)
+    if tracker.done():
+        return tracker.key
+    return None
+
+
+def archive(key):
+    scode, acno, lang = get_details(key)
+    create_archive(scode, acno, lang)
+    size = upload_archive_to_r2(scode, acno, lang)
+    get_manifest().mark_done(reprocessed_tag, scode, acno, lang, size)
+    return key
+
+
+def delete(key):
+    s3 = get_boto_client()
+    s3.delete_object(Bucket=bucket_name_from, Key=key)
     scode, acno, lang = get_details(key)
-    download_pdf_archive_from_r2(scode, acno, lang)
-    q.put(key)
-q.put('DONE')
-q.join()
+    get_manifest().remove(bucket_name_from, scode, acno, lang)
+    # a source uploaded again later has to be converted again
+    get_manifest().remove(reprocessed_tag, scode, acno, lang)
+    return None
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--downloaders', type=int, default=2)
+    parser.add_argument('--converters', type=int, default=4)
+    parser.add_argument('--uploaders', type=int, default=2)
+    parser.add_argument('--deleters', type=int, default=1)
+    parser.add_argument('--queue-size', type=int, default=3)
+    parser.add_argument('--num-procs', type=int, default=num_procs,
+                        help='processes converting pages')
+    add_webp_args(parser)
+    parser.add_argument('--report-interval', type=int, default=60)
+    metrics.add_metrics_args(parser)
+    args = parser.parse_args()
+    num_procs = args.num_procs
+    webp_encoder = args.webp_encoder
+    webp_level = args.webp_level
+    metrics.start_metrics(args)
+
+    delete_stage  = Stage('delete', delete, args.deleters, args.queue_size * 10)
+    archive_stage = Stage('archive', archive, args.uploaders, args.queue_size, delete_stage)
+    # pdf level, so it gets more room than the archive level stages
+    convert_stage = Stage('convert', convert, args.converters, args.queue_size * 10, archive_stage)
+    download_stage = Stage('download', download, args.downloaders, args.queue_size, archive_stage)
+
+    pipeline = Pipeline([ download_stage, convert_stage, archive_stage, delete_stage ],
+                        args.report_interval)
+    pipeline.start()
+
+    import_checkpoint()
+    manifest = get_manifest()
+    for key in list_keys():
+        if manifest.is_done(reprocessed_tag, *get_details(key)):
+            # uploaded in an earlier run, only the source is left to clean up
+            delete_stage.put(key)
+            continue
+        download_stage.put(key)
+
+    pipeline.close()
@@ -0,0 +1,116 @@
+import json
+import time
+import threading
+from pathlib import Path
+
+# the log is kept as a series of segment files named by creation time, a
+# watcher starts a fresh one when it comes up and segments that every live
+# watcher has moved past are dropped, so the log does not grow without bound
+events_dir = Path('data/events')
+events_lock = threading.Lock()
+
+# writers move on to a new segment once the current one gets this big
+max_segment_size = 16 * 1024 * 1024
+
+# a watcher that has not touched its cursor in this long is taken to be dead
+# and no longer holds back the removal of the segments it was reading
+cursor_ttl = 300
+
+
+def get_segments():
+    return sorted(events_dir.glob('*.jsonl'))
+
+
+def new_segment():
+    events_dir.mkdir(exist_ok=True, parents=True)
+    segment = events_dir / f'{time.time_ns()}.jsonl'
+    segment.touch()
+    return segment
+
+
+def emit_event(kind, file):
+    line = json.dumps({ 'kind': kind, 'file': str(file) }) + '\n'
+    with events_lock:
+        segments = get_segments()
+        if len(segments) == 0 or segments[-1].stat().st_size >= max_segment_size:
+            segment = new_segment()
+        else:
+            segment = segments[-1]
+        with open(segment, 'a') as f:
+            f.write(line)
+
+
+def set_cursor(consumer, segment):
+    (events_dir / f'{consumer}.cursor').write_text(segment.name)
+
+
+def drop_consumed_segments():
+    # segments before the oldest one a live watcher is still reading
+    cutoff = time.time() - cursor_ttl
+    in_use = []
+    for cursor_file in events_dir.glob('*.cursor'):
+        try:
+            if cursor_file.stat().st_mtime >= cutoff:
+                in_use.append(cursor_file.read_text().strip())
+        except FileNotFoundError:
+            continue
+    segments = get_segments()
+    if len(segments) == 0:
+        return
+    oldest = min(in_use, default=segments[-1].name)
+    for segment in segments:
+        if segment.name < oldest:
+            segment.unlink(missing_ok=True)
+
+
+def start_events(consumer):
+    # everything logged before this segment is left to the caller's own full
+    # pass, so the older segments are of no more use to this consumer
+    segment = new_segment()
+    set_cursor(consumer, segment)
+    drop_consumed_segments()
+    return segment
+
+
+def get_next_segment(segment):
+    for s in get_segments():
+        if s.name > segment.name:
+            return s
+    return None
+
+
+def follow_events(segment, consumer, poll_interval=1):
+    # yields (kind, file) for every event logged from segment onwards, forever
+    cursor_file = events_dir / f'{consumer}.cursor'
+    f = open(segment, 'rb')
+    buf = b''
+    next_segment = None
+    try:
+        while True:
+            line = f.readline()
+            if line != b'':
+                buf += line
+                # the writer may be half way through a line
+                if not buf.endswith(b'\n'):
+                    continue
+                event = json.loads(buf)
+                buf = b''
+                yield event['kind'], Path(event['file'])
+                continue
+
+            if next_segment is not None:
+                # the old segment was drained once more after a writer that
+                # picked it just before the switch had time to finish
+                f.close()
+                segment = next_segment
+                f = open(segment, 'rb')
+                next_segment = None
+                set_cursor(consumer, segment)
+                drop_consumed_segments()
+                continue
+
+            cursor_file.touch()
+            next_segment = get_next_segment(segment)
+            time.sleep(poll_interval)
+    finally:
+        f.close()
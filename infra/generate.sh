@@ -6,5 +6,8 @@ R2_CREDENTIALS_BASE64=$(cat r2_credentials.json | base64)
 PB_TOKEN=$(cat pb_token.txt)
 SWAP_SIZE_GB=16
 SELECTED_STATE_CODES=''
+# extra scrape.py arguments, for example '--coordinator /mnt/shared/jobs.db' to lease
+# jobs from a shared queue instead of handling whole states ( add --seed on one box )
+SCRAPE_ARGS=''
 
-sed -e "s/<SELECTED_STATE_CODES>/$SELECTED_STATE_CODES/g" -e "s/<SWAP_SIZE_GB>/$SWAP_SIZE_GB/g" -e "s/<PB_TOKEN>/$PB_TOKEN/g" -e "s/<R2_CREDENTIALS_BASE64>/$R2_CREDENTIALS_BASE64/g" cloud_init.sh.tmpl > cloud_init.sh 
+sed -e "s/<SELECTED_STATE_CODES>/$SELECTED_STATE_CODES/g" -e "s|<SCRAPE_ARGS>|$SCRAPE_ARGS|g" -e "s/<SWAP_SIZE_GB>/$SWAP_SIZE_GB/g" -e "s/<PB_TOKEN>/$PB_TOKEN/g" -e "s/<R2_CREDENTIALS_BASE64>/$R2_CREDENTIALS_BASE64/g" cloud_init.sh.tmpl > cloud_init.sh 
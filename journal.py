@@ -0,0 +1,118 @@
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+journal_file = Path('data/journal.db')
+
+# rolls get published over time, a roll seen missing is tried again after this
+unavailable_ttl = 7 * 24 * 3600
+
+
+class Journal:
+    # per part record of the crawl, so that a restarted run can tell what is
+    # finished without probing the disk, along with the roll urls known to
+    # be unpublished for a state or constituency
+    def __init__(self, path):
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            # a lost entry only costs a re-download, no need to fsync every attempt
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS parts ('
+                              'scode TEXT, acno TEXT, lang TEXT, partno INTEGER, '
+                              'state TEXT, attempts INTEGER, roll TEXT, size INTEGER, updated_at REAL, '
+                              'PRIMARY KEY (scode, acno, lang, partno))')
+            # languages whose parts were all downloaded, finished once all of
+            # them are converted as well
+            self.conn.execute('CREATE TABLE IF NOT EXISTS langs ('
+                              'scode TEXT, acno TEXT, lang TEXT, num_parts INTEGER, updated_at REAL, '
+                              'PRIMARY KEY (scode, acno, lang))')
+            # acno is '*' when the roll is missing for the whole state
+            self.conn.execute('CREATE TABLE IF NOT EXISTS unavailable_rolls ('
+                              'scode TEXT, acno TEXT, roll TEXT, updated_at REAL, '
+                              'PRIMARY KEY (scode, acno, roll))')
+        self.unavailable = {}
+        rows = self.conn.execute('SELECT scode, acno, roll, updated_at FROM unavailable_rolls').fetchall()
+        for scode, acno, roll, updated_at in rows:
+            self.unavailable[(scode, acno, roll)] = updated_at
+
+    def get_part(self, scode, acno, lang, partno):
+        with self.lock:
+            row = self.conn.execute('SELECT state, attempts, roll, size FROM parts '
+                                    'WHERE scode = ? AND acno = ? AND lang = ? AND partno = ?',
+                                    (str(scode), str(acno), lang, int(partno))).fetchone()
+        if row is None:
+            return None
+        return { 'state': row[0], 'attempts': row[1], 'roll': row[2], 'size': row[3] }
+
+    def mark_pending(self, scode, acno, lang, partno):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO parts VALUES (?, ?, ?, ?, 'pending', 0, NULL, NULL, ?)",
+                              (str(scode), str(acno), lang, int(partno), time.time()))
+
+    def record_attempt(self, scode, acno, lang, partno, roll):
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE parts SET attempts = attempts + 1, roll = ?, updated_at = ? '
+                              'WHERE scode = ? AND acno = ? AND lang = ? AND partno = ?',
+                              (roll, time.time(), str(scode), str(acno), lang, int(partno)))
+
+    def mark_done(self, scode, acno, lang, partno, roll, size):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO parts VALUES (?, ?, ?, ?, 'done', 0, ?, ?, ?) "
+                              "ON CONFLICT (scode, acno, lang, partno) DO UPDATE SET "
+                              "state = 'done', roll = excluded.roll, size = excluded.size, "
+                              "updated_at = excluded.updated_at",
+                              (str(scode), str(acno), lang, int(partno), roll, size, time.time()))
+
+    def mark_converted(self, scode, acno, lang, partno):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE parts SET state = 'converted', updated_at = ? "
+                              "WHERE scode = ? AND acno = ? AND lang = ? AND partno = ?",
+                              (time.time(), str(scode), str(acno), lang, int(partno)))
+
+    def mark_lang_downloaded(self, scode, acno, lang, num_parts):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO langs VALUES (?, ?, ?, ?, ?)',
+                              (str(scode), str(acno), lang, num_parts, time.time()))
+
+    def get_finished_langs(self, scode):
+        # (acno, lang) pairs of the state with every part downloaded and converted
+        with self.lock:
+            rows = self.conn.execute("SELECT l.acno, l.lang FROM langs l "
+                                     "WHERE l.scode = ? AND l.num_parts = "
+                                     "(SELECT COUNT(*) FROM parts p WHERE p.scode = l.scode AND p.acno = l.acno "
+                                     "AND p.lang = l.lang AND p.state = 'converted')",
+                                     (str(scode),)).fetchall()
+        return set([ tuple(r) for r in rows ])
+
+    def mark_unavailable(self, scode, acno, roll):
+        # acno of None marks the roll missing for every constituency of the state
+        key = (str(scode), '*' if acno is None else str(acno), roll)
+        now = time.time()
+        with self.lock, self.conn:
+            self.unavailable[key] = now
+            self.conn.execute('INSERT OR REPLACE INTO unavailable_rolls VALUES (?, ?, ?, ?)', key + (now,))
+
+    def get_unavailable_rolls(self, scode, acno):
+        cutoff = time.time() - unavailable_ttl
+        rolls = set()
+        with self.lock:
+            for roll in [ 'draft', 'final', 'ge' ]:
+                for key in [ (str(scode), '*', roll), (str(scode), str(acno), roll) ]:
+                    if self.unavailable.get(key, 0) >= cutoff:
+                        rolls.add(roll)
+        return rolls
+
+
+journal = None
+journal_lock = threading.Lock()
+
+def get_journal():
+    global journal
+    with journal_lock:
+        if journal is None:
+            journal = Journal(journal_file)
+    return journal
@@ -0,0 +1,86 @@
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+manifest_file = Path('data/manifest.db')
+
+
+def parse_key(key):
+    parts = key.split('/')
+    scode = parts[0]
+    acno  = parts[1]
+    lang  = parts[2][:-4]
+    return scode, acno, lang
+
+
+class Manifest:
+    # local record of the archives in each bucket, kept up to date as uploads
+    # finish, so that nobody has to list the whole bucket to know what is done
+    def __init__(self, path):
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.lock = threading.Lock()
+        # the scraper and the archiver run as separate processes on the same file
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS archives ('
+                              'bucket TEXT, scode TEXT, acno TEXT, lang TEXT, '
+                              'size INTEGER, updated_at REAL, '
+                              'PRIMARY KEY (bucket, scode, acno, lang))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS reconciled ('
+                              'bucket TEXT PRIMARY KEY, reconciled_at REAL)')
+
+    def mark_done(self, bucket, scode, acno, lang, size):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?)',
+                              (bucket, str(scode), str(acno), lang, size, time.time()))
+
+    def remove(self, bucket, scode, acno, lang):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM archives WHERE bucket = ? AND scode = ? AND acno = ? AND lang = ?',
+                              (bucket, str(scode), str(acno), lang))
+
+    def is_done(self, bucket, scode, acno, lang):
+        with self.lock:
+            row = self.conn.execute('SELECT 1 FROM archives WHERE bucket = ? AND scode = ? AND acno = ? AND lang = ?',
+                                    (bucket, str(scode), str(acno), lang)).fetchone()
+        return row is not None
+
+    def get_done_set(self, bucket):
+        with self.lock:
+            rows = self.conn.execute('SELECT scode, acno, lang FROM archives WHERE bucket = ?',
+                                     (bucket,)).fetchall()
+        return set([ tuple(r) for r in rows ])
+
+    def last_reconciled(self, bucket):
+        with self.lock:
+            row = self.conn.execute('SELECT reconciled_at FROM reconciled WHERE bucket = ?',
+                                    (bucket,)).fetchone()
+        return None if row is None else row[0]
+
+    def reconcile(self, bucket, keys, listed_at):
+        # keys is a key -> size map from a full listing of the bucket started
+        # at listed_at, entries recorded after that are left alone
+        rows = []
+        for key, size in keys.items():
+            if not key.endswith('.tar') or key.count('/') != 2:
+                continue
+            scode, acno, lang = parse_key(key)
+            rows.append((bucket, scode, acno, lang, size, listed_at))
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM archives WHERE bucket = ? AND updated_at < ?', (bucket, listed_at))
+            self.conn.executemany('INSERT OR IGNORE INTO archives VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.conn.execute('INSERT OR REPLACE INTO reconciled VALUES (?, ?)', (bucket, now))
+
+
+manifest = None
+manifest_lock = threading.Lock()
+
+def get_manifest():
+    global manifest
+    with manifest_lock:
+        if manifest is None:
+            manifest = Manifest(manifest_file)
+    return manifest
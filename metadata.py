@@ -0,0 +1,78 @@
+import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+raw_dir = Path('data/raw')
+
+# a crawl reads each constituency's lists about once, the archiver keeps
+# coming back to the same few, so only the recently used ones are kept
+max_cached_files = 1024
+
+
+class MetadataIndex:
+    # parsed copies of the json lists cached under raw_dir, along with dict
+    # indexes over them, an entry is rebuilt when its file's mtime changes
+    def __init__(self, raw_dir, max_entries=max_cached_files):
+        self.raw_dir = raw_dir
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+
+    def load(self, path, kind='list', build=None):
+        try:
+            mtime = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+        key = (path, kind)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.cache.move_to_end(key)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+
+        value = json.loads(path.read_text())
+        if build is not None:
+            value = build(value)
+        with self.lock:
+            self.cache[key] = (mtime, value)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return value
+
+    def get_state_list(self):
+        return self.load(self.raw_dir / 'state_list.json')
+
+    def get_district_list(self, scode):
+        return self.load(self.raw_dir / f'{scode}' / 'district_list.json')
+
+    def get_constituency_list(self, scode):
+        return self.load(self.raw_dir / f'{scode}' / 'constituency_list.json')
+
+    def get_constituency_map(self, scode):
+        return self.load(self.raw_dir / f'{scode}' / 'constituency_list.json', 'map',
+                         lambda cinfos: { (c['stateCd'], c['asmblyNo']):c for c in cinfos })
+
+    def get_constituency(self, scode, acno):
+        cmap = self.get_constituency_map(scode)
+        if cmap is None:
+            return None
+        return cmap.get((str(scode), int(acno)))
+
+    def get_langs(self, scode, acno):
+        return self.load(self.raw_dir / f'{scode}' / f'{acno}' / 'langs.json')
+
+    def get_parts(self, scode, acno):
+        return self.load(self.raw_dir / f'{scode}' / f'{acno}' / 'parts.json')
+
+metadata = None
+metadata_lock = threading.Lock()
+
+def get_metadata():
+    global metadata
+    with metadata_lock:
+        if metadata is None:
+            metadata = MetadataIndex(raw_dir)
+    return metadata
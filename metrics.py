@@ -0,0 +1,222 @@
+import os
+import time
+import inspect
+import functools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+default_buckets = [ 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300 ]
+
+registry = []
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    inner = ','.join([ f'{k}="{v}"' for k, v in labels ])
+    return '{' + inner + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [ f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter' ]
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f'{self.name}{format_labels(key)} {value}')
+        return lines
+
+
+class Gauge:
+    # either set explicitly or read from fn every time the metrics are rendered
+    def __init__(self, name, help_text, fn=None):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, fn):
+        self.fn = fn
+
+    def render(self):
+        lines = [ f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge' ]
+        if self.fn is not None:
+            lines.append(f'{self.name} {self.fn()}')
+            return lines
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f'{self.name}{format_labels(key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=default_buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # labels -> (per bucket counts, sum, count)
+        self.values = {}
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [ f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram' ]
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, c in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{format_labels(key + (("le", bound),))} {c}')
+                lines.append(f'{self.name}_bucket{format_labels(key + (("le", "+Inf"),))} {count}')
+                lines.append(f'{self.name}_sum{format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{format_labels(key)} {count}')
+        return lines
+
+
+calls_total = Counter('eroll_calls_total', 'instrumented calls by function and outcome')
+call_seconds = Histogram('eroll_call_seconds', 'instrumented call latency by function')
+responses_total = Counter('eroll_responses_total', 'gateway responses by endpoint and http status')
+response_seconds = Histogram('eroll_response_seconds', 'gateway response latency by endpoint')
+downloaded_bytes_total = Counter('eroll_downloaded_bytes_total', 'pdf bytes written to disk')
+uploaded_bytes_total = Counter('eroll_uploaded_bytes_total', 'archive bytes uploaded by bucket')
+pages_converted_total = Counter('eroll_pages_converted_total', 'pdf pages converted to webp')
+send_queue_depth = Gauge('eroll_send_queue_depth', 'pdfs waiting for conversion')
+conversion_pending = Gauge('eroll_conversion_pending', 'page ranges submitted to the conversion pool and not finished')
+
+
+def get_outcome(ex, outcomes):
+    for ex_class, label in outcomes:
+        if isinstance(ex, ex_class):
+            return label
+    return 'error'
+
+
+def instrumented(name, outcomes=()):
+    # times every call of the wrapped function and counts it under the
+    # label of the first (exception class, label) pair in outcomes that
+    # matches what it raised, 'success' or 'error' otherwise, coroutine
+    # functions are timed until they finish rather than until they return
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.monotonic()
+                outcome = 'error'
+                try:
+                    result = await fn(*args, **kwargs)
+                    outcome = 'success'
+                    return result
+                except Exception as ex:
+                    outcome = get_outcome(ex, outcomes)
+                    raise
+                finally:
+                    call_seconds.observe(time.monotonic() - start, fn=name)
+                    calls_total.inc(fn=name, outcome=outcome)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            outcome = 'error'
+            try:
+                result = fn(*args, **kwargs)
+                outcome = 'success'
+                return result
+            except Exception as ex:
+                outcome = get_outcome(ex, outcomes)
+                raise
+            finally:
+                call_seconds.observe(time.monotonic() - start, fn=name)
+                calls_total.inc(fn=name, outcome=outcome)
+        return wrapper
+    return decorator
+
+
+def record_response(endpoint, status, latency):
+    responses_total.inc(endpoint=endpoint, status=status)
+    response_seconds.observe(latency, endpoint=endpoint)
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics_file(metrics_file):
+    # node_exporter's textfile collector should never see a half written file
+    tmp_file = metrics_file.with_name(metrics_file.name + '.tmp')
+    tmp_file.write_text(render())
+    os.replace(tmp_file, metrics_file)
+
+
+def start_metrics_writer(metrics_file, interval=15):
+    metrics_file = Path(metrics_file)
+    metrics_file.parent.mkdir(exist_ok=True, parents=True)
+
+    def writer():
+        while True:
+            write_metrics_file(metrics_file)
+            time.sleep(interval)
+
+    threading.Thread(target=writer, daemon=True).start()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port):
+    server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_metrics_args(parser):
+    parser.add_argument('--metrics-file',
+                        help='periodically write prometheus text format metrics to this file')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve prometheus metrics on this local port')
+
+
+def start_metrics(args):
+    if args.metrics_file is not None:
+        start_metrics_writer(args.metrics_file)
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_port)
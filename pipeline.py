@@ -0,0 +1,85 @@
+import time
+import queue
+import threading
+
+DONE = 'DONE'
+
+
+class Stage:
+    # a pool of worker threads draining a bounded queue, whatever fn returns
+    # ( other than None ) is passed on to the next stage
+    def __init__(self, name, fn, num_workers, queue_size, next_stage=None):
+        self.name = name
+        self.fn = fn
+        self.next_stage = next_stage
+        self.in_q = queue.Queue(maxsize=queue_size)
+        self.threads = [ threading.Thread(target=self.run, daemon=True) for i in range(num_workers) ]
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.started_at = None
+
+    def start(self):
+        self.started_at = time.monotonic()
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item):
+        self.in_q.put(item)
+
+    def run(self):
+        while True:
+            item = self.in_q.get()
+            if item == DONE:
+                self.in_q.task_done()
+                break
+            try:
+                result = self.fn(item)
+            except Exception as ex:
+                print(f'ERROR: {self.name} failed for {item} - {ex}')
+                with self.lock:
+                    self.failed += 1
+                self.in_q.task_done()
+                continue
+            with self.lock:
+                self.processed += 1
+            if result is not None and self.next_stage is not None:
+                self.next_stage.put(result)
+            self.in_q.task_done()
+
+    def close(self):
+        for thread in self.threads:
+            self.in_q.put(DONE)
+        for thread in self.threads:
+            thread.join()
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started_at, 1)
+        with self.lock:
+            processed = self.processed
+            failed = self.failed
+        return f'{self.name}: {processed} done ({processed / elapsed:.2f}/s), {failed} failed, {self.in_q.qsize()} queued'
+
+
+class Pipeline:
+    def __init__(self, stages, report_interval):
+        self.stages = stages
+        self.report_interval = report_interval
+        self.stop_event = threading.Event()
+
+    def reporter(self):
+        while not self.stop_event.wait(self.report_interval):
+            print('STATS: ' + ' | '.join([ s.report() for s in self.stages ]))
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        threading.Thread(target=self.reporter, daemon=True).start()
+
+    def close(self):
+        # stages are shut down in order, so everything an upstream stage
+        # produced is drained before the next one is told to stop
+        for stage in self.stages:
+            stage.close()
+        self.stop_event.set()
+        print('STATS: ' + ' | '.join([ s.report() for s in self.stages ]))
@@ -0,0 +1,73 @@
+import time
+import asyncio
+import threading
+
+increase_step = 0.05
+decrease_factor = 0.5
+slow_decrease_factor = 0.9
+
+
+class TokenBucket:
+    # AIMD tuned token bucket, the rate creeps up on every quick success,
+    # backs off a little on slow replies and is halved on server errors
+    def __init__(self, name, rate, burst, min_rate, max_rate, target_latency):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def record_failure(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * decrease_factor)
+            print(f'\t\t\tWARNING: slowing {self.name} down to {self.rate:.2f} req/s')
+
+    def record(self, status_code, latency):
+        if status_code >= 500 or status_code == 429:
+            self.record_failure()
+            return
+        with self.lock:
+            if latency > self.target_latency:
+                self.rate = max(self.min_rate, self.rate * slow_decrease_factor)
+            else:
+                self.rate = min(self.max_rate, self.rate + increase_step)
+
+
+buckets = {
+    'captcha-service'               : TokenBucket('captcha-service', 5, 5, 0.2, 50, 5),
+    'get-part-list'                 : TokenBucket('get-part-list', 2, 2, 0.1, 20, 10),
+    'get-ac-languages'              : TokenBucket('get-ac-languages', 2, 2, 0.1, 20, 10),
+    'generate-published-geroll'     : TokenBucket('generate-published-geroll', 5, 5, 0.2, 50, 60),
+    'generate-published-supplement' : TokenBucket('generate-published-supplement', 5, 5, 0.2, 50, 60),
+    'generate-published-eroll'      : TokenBucket('generate-published-eroll', 5, 5, 0.2, 50, 60),
+}
+
+def get_bucket(url):
+    for endpoint, bucket in buckets.items():
+        if url.find(f'/{endpoint}') != -1:
+            return bucket
+    return None
@@ -1,22 +1,39 @@
 import io
+import os
 import json
 import time
 import threading
 import queue
 import base64
+import shutil
+import socket
+import traceback
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from pprint import pprint
 
 import requests
-from requests.exceptions import RequestException, JSONDecodeError
+from requests.exceptions import RequestException
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from imgcat import imgcat
 from PIL import Image
 
-from captcha.solve import solve_captcha
+from captcha.solve import solve_captcha_with_confidence, is_confident
+from ratelimit import get_bucket
+from captcha_pool import CaptchaPool
 
-from utils import convert_to_pages, get_bucket_keys
+from utils import (convert_to_pages, reconcile_manifest, Base64FieldDecoder,
+                   add_webp_args, webp_encoder, webp_lossless_level)
+from manifest import get_manifest
+from events import emit_event
+from metadata import get_metadata
+from journal import get_journal
+from coordinator import Coordinator, LeaseKeeper
+import metrics
+from metrics import instrumented
 
 base_url     = 'https://voters.eci.gov.in/download-eroll'
 api_base_url = 'https://gateway-voters.eci.gov.in/api/v1'
@@ -32,22 +49,56 @@ draft_url      = api_base_url + '/printing-publish/generate-published-eroll'
 const_list_url_tpl = api_base_url + '/common/constituencies?stateCode={}'
 district_url_tpl   = api_base_url + '/common/districts/{}'
 
+endpoint_names = {
+    captcha_url   : 'captcha',
+    lang_url      : 'langs',
+    part_list_url : 'parts',
+    ge_url        : 'ge',
+    final_url     : 'final',
+    draft_url     : 'draft',
+}
+
 
 data_dir = Path('data')
 raw_dir = data_dir / 'raw'
 captcha_dir = Path('captcha/data')
+tmp_dir = data_dir / 'tmp'
 
 done_set = set()
 
+# set when jobs are leased from a shared queue instead of walking the states
+coordinator = None
+seed_coordinator = False
+
 selected_state_codes = []
 
+num_workers = 1
+captcha_backend = 'tesseract'
+# 0 turns the gate off, tune it with captcha/bench.py before raising it
+min_captcha_confidence = 0
+captcha_pool = None
+captcha_pool_timeout = 300
+worker_local = threading.local()
+
 max_attempts = 5
 initial_delay = 100
+retry_delay = 5
+
+stream_chunk_size = 1024 * 64
 
 try_count = 1
 curr_delay = initial_delay
 
-send_q = queue.Queue()
+# downloads block once this many pdfs are waiting for conversion or, when
+# min_free_disk_mb is set, the disk holding data_dir has less than that left
+num_converters = 1
+send_q_size = 32
+min_free_disk_mb = 0
+disk_check_interval = 10
+
+webp_level = webp_lossless_level
+
+send_q = queue.Queue(maxsize=send_q_size)
 
 class RetriableException(Exception):
     pass
@@ -56,23 +107,113 @@ class DelayedRetriableException(Exception):
     pass
 
 class ChangeUrlRetriableException(Exception):
-    pass
-
-def raise_delayed_exception_if_needed(resp, status_codes=[500]):
-    if resp.status_code not in status_codes:
+    def __init__(self, msg, state_wide=False):
+        super().__init__(msg)
+        # the roll is missing for every constituency of the state, not just this one
+        self.state_wide = state_wide
+
+download_outcomes = [ (RetriableException, 'captcha_fail'),
+                      (ChangeUrlRetriableException, 'change_url'),
+                      (DelayedRetriableException, 'retry') ]
+
+def limited_call(method, url, **kwargs):
+    bucket = get_bucket(url)
+    if bucket is None:
+        return method(url, **kwargs)
+    bucket.acquire()
+    start = time.monotonic()
+    try:
+        resp = method(url, **kwargs)
+    except RequestException:
+        bucket.record_failure()
+        raise
+    latency = time.monotonic() - start
+    bucket.record(resp.status_code, latency)
+    metrics.record_response(endpoint_names.get(url, url), resp.status_code, latency)
+    return resp
+
+def with_retries(fn, *args):
+    # retry just the failing request, the whole crawl is restarted only
+    # when the gateway keeps failing past max_attempts
+    delay = retry_delay
+    attempt = 1
+    while True:
+        try:
+            return fn(*args)
+        except DelayedRetriableException as ex:
+            if attempt >= max_attempts:
+                raise ex
+            print(f'\t\t\tWARNING: {ex}.. retrying in {delay} secs')
+            time.sleep(delay)
+            attempt += 1
+            delay *= 2
+
+# the response checks below take the http status and the body text so
+# that the requests and the httpx based crawlers classify them alike
+
+def raise_delayed_exception_if_needed(status, text, status_codes=[500]):
+    if status not in status_codes:
         return
     try:
-        data = resp.json()
+        data = json.loads(text)
         msg = f'message: {data.get("message", None)}'
-    except JSONDecodeError:
-        msg = resp.text
+    except json.JSONDecodeError:
+        msg = text
     raise DelayedRetriableException(msg)
 
+def parse_listing_response(status, text, what, url):
+    # payload of a constituency level listing, what describes it for errors
+    if status >= 400:
+        raise_delayed_exception_if_needed(status, text)
+        raise Exception(f'Unable to get {what} from {url}')
+
+    data = json.loads(text)
+    if data['status'] != 'Success':
+        raise DelayedRetriableException(f'Unable to get {what} from {url}, message: {data["message"]}, status: {data["status"]}')
+    return data['payload']
+
+def parse_captcha_response(status, text):
+    # returns the captcha id and the image bytes
+    if status >= 400:
+        raise_delayed_exception_if_needed(status, text, status_codes=[400,500])
+        print(text, status)
+        raise Exception(f'Unable to get captcha at {captcha_url}')
+
+    data = json.loads(text)
+    if data['status'] != 'Success':
+        raise DelayedRetriableException(f'Unable to get captcha at {captcha_url}, message: {data["message"]}')
+
+    if data['captcha'] is None:
+        raise DelayedRetriableException('Got empty captcha')
+
+    return data['id'], base64.b64decode(data['captcha'])
+
+def raise_download_error(status, text, roll_url, postdata):
+    # always raises, for a download call that did not succeed
+    if status == 400:
+        msg = json.loads(text)['message']
+        if msg == 'Invalid Catpcha':
+            raise RetriableException('Failed to solve captcha')
+    if status == 401:
+        msg = json.loads(text)['message']
+        if msg.find('has not been published for this AC') != -1:
+            raise ChangeUrlRetriableException(f'Roll not available for {roll_url}')
+        if msg.find('not published for this state') != -1:
+            raise ChangeUrlRetriableException(f'Roll not available for {roll_url}', state_wide=True)
+    raise_delayed_exception_if_needed(status, text)
+    print('\t\t\tWARNING: Failed request - ', text)
+    raise Exception(f'Unable to get roll for part {postdata} at {roll_url}')
+
+def check_download_data(data, roll_url, postdata):
+    if data['status'] != 'Success':
+        raise DelayedRetriableException(f'Unable to get roll for part {postdata} at {roll_url}, message: {data["message"]}, status: {data["status"]}')
+
 
 def get_state_list(session):
     state_list_file = raw_dir / 'state_list.json'
-    if state_list_file.exists():
-        return json.loads(state_list_file.read_text())
+    state_list = get_metadata().get_state_list()
+    if state_list is not None:
+        return state_list
 
     resp = session.get(state_list_url)
     if not resp.ok:
@@ -89,14 +230,15 @@ def get_district_list(session, scode):
     state_dir.mkdir(exist_ok=True, parents=True)
 
     d_file = state_dir / 'district_list.json'
-    if d_file.exists():
-        return json.loads(d_file.read_text())
+    district_list = get_metadata().get_district_list(scode)
+    if district_list is not None:
+        return district_list
 
     dist_list_url = district_url_tpl.format(scode)
 
     resp = session.get(dist_list_url)
     if not resp.ok:
-        raise_delayed_exception_if_needed(resp)
+        raise_delayed_exception_if_needed(resp.status_code, resp.text)
         raise Exception(f'Unable to get district list for {scode} from {dist_list_url}')
 
     resp_text = resp.text
@@ -110,14 +252,15 @@ def get_constituency_list(session, scode):
     state_dir.mkdir(exist_ok=True, parents=True)
 
     c_file = state_dir / 'constituency_list.json'
-    if c_file.exists():
-        return json.loads(c_file.read_text())
+    constituency_list = get_metadata().get_constituency_list(scode)
+    if constituency_list is not None:
+        return constituency_list
 
     const_list_url = const_list_url_tpl.format(scode)
 
     resp = session.get(const_list_url)
     if not resp.ok:
-        raise_delayed_exception_if_needed(resp)
+        raise_delayed_exception_if_needed(resp.status_code, resp.text)
         raise Exception(f'Unable to get constituency list for {scode} from {const_list_url}')
 
     resp_text = resp.text
@@ -135,24 +278,18 @@ def get_constituency_langs(session, c_info):
     c_dir.mkdir(exist_ok=True, parents=True)
 
     lang_file = c_dir / 'langs.json'
-    if lang_file.exists():
-        return json.loads(lang_file.read_text())
+    langs = get_metadata().get_langs(scode, acno)
+    if langs is not None:
+        return langs
 
     postdata = { 'acNumber': acno, 'districtCd': dcode, 'stateCd': scode }
     try:
-        resp = session.post(lang_url, json=postdata)
+        resp = limited_call(session.post, lang_url, json=postdata)
     except RequestException as ex:
         raise DelayedRetriableException(str(ex))
 
-    if not resp.ok:
-        raise_delayed_exception_if_needed(resp)
-        raise Exception(f'Unable to get language list for constituency {acno} of {scode} from {lang_url}')
-    
-    data = json.loads(resp.text)
-    if data['status'] != 'Success':
-        raise DelayedRetriableException(f'Unable to get language list for constituency {acno} of {scode} from {lang_url}, message: {data["message"]}, status: {data["status"]}')
-
-    langs = data['payload']
+    langs = parse_listing_response(resp.status_code, resp.text,
+                                   f'language list for constituency {acno} of {scode}', lang_url)
 
     lang_file.write_text(json.dumps(langs))
 
@@ -168,80 +305,152 @@ def get_constituency_parts(session, c_info):
     c_dir.mkdir(exist_ok=True, parents=True)
 
     parts_file = c_dir / 'parts.json'
-    if parts_file.exists():
-        return json.loads(parts_file.read_text())
+    parts = get_metadata().get_parts(scode, acno)
+    if parts is not None:
+        return parts
 
     postdata = { 'acNumber': acno, 'districtCd': dcode, 'stateCd': scode }
     try:
-        resp = session.post(part_list_url, json=postdata)
+        resp = limited_call(session.post, part_list_url, json=postdata)
     except RequestException as ex:
         raise DelayedRetriableException(str(ex))
-    if not resp.ok:
-        raise_delayed_exception_if_needed(resp)
-        raise Exception(f'Unable to get parts list for constituency {acno} of {scode} from {part_list_url}')
-    
-    data = json.loads(resp.text)
-    if data['status'] != 'Success':
-        raise DelayedRetriableException(f'Unable to get parts list for constituency {acno} of {scode} from {part_list_url}, message: {data["message"]}, status: {data["status"]}')
-
-    parts = data['payload']
+    parts = parse_listing_response(resp.status_code, resp.text,
+                                   f'parts list for constituency {acno} of {scode}', part_list_url)
 
     parts_file.write_text(json.dumps(parts))
 
     return parts
 
+@instrumented('get_captcha', [ (DelayedRetriableException, 'retry') ])
 def get_captcha(session):
     try:
-        resp = session.get(captcha_url)
+        resp = limited_call(session.get, captcha_url)
     except RequestException as ex:
         raise DelayedRetriableException(str(ex))
 
-    if not resp.ok:
-        raise_delayed_exception_if_needed(resp, status_codes=[400,500])
-        print(resp.text, resp.status_code)
-        raise Exception(f'Unable to get captcha at {captcha_url}')
+    captcha_id, img_bytes = parse_captcha_response(resp.status_code, resp.text)
+    img = Image.open(io.BytesIO(img_bytes))
+    return captcha_id, img
 
-    data = resp.json()
-    if data['status'] != 'Success':
-        raise DelayedRetriableException(f'Unable to get captcha at {captcha_url}, message: {data["message"]}')
+def write_streamed_pdf(chunks, pdf_file):
+    # decode the pdf straight to disk instead of holding the json text,
+    # the base64 string and the decoded bytes in memory all at once
+    tmp_dir.mkdir(exist_ok=True, parents=True)
+    fd, tmp_name = tempfile.mkstemp(dir=tmp_dir, suffix='.pdf')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            decoder = Base64FieldDecoder('file', f)
+            for chunk in chunks:
+                decoder.feed(chunk)
+            data = decoder.close()
+        if data['status'] == 'Success' and data.get('file', None) is not None:
+            os.replace(tmp_name, pdf_file)
+            metrics.downloaded_bytes_total.inc(pdf_file.stat().st_size)
+    finally:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+    return data
 
-    if data['captcha'] is None:
-        raise DelayedRetriableException('Got empty captcha')
+solve_outcomes = [ (RetriableException, 'not_confident') ]
 
-    img_bytes = base64.b64decode(data['captcha'])
-    img = Image.open(io.BytesIO(img_bytes))
-    return data['id'], img
+def check_captcha_confidence(solution):
+    # a fresh captcha is much cheaper than a rejected download call
+    if not is_confident(solution, min_captcha_confidence):
+        raise RetriableException(f'Could not solve captcha confidently, got "{solution.text}"')
+    return solution.text
+
+@instrumented('solve_captcha', solve_outcomes)
+def solve_captcha_gated(captcha_img):
+    solution = solve_captcha_with_confidence(captcha_img, captcha_backend)
+    return check_captcha_confidence(solution)
 
-def make_download_call(roll_url, session, postdata):
+def solve_new_captcha(session):
+    captcha_id, captcha_img = get_captcha(session)
+    return captcha_id, solve_captcha_gated(captcha_img)
+
+def fill_captcha_pool():
+    try:
+        return solve_new_captcha(get_worker_session())
+    except RetriableException:
+        return None
+
+def get_solved_captcha(session):
+    if captcha_pool is None:
+        return solve_new_captcha(session)
     try:
-        resp = session.post(roll_url, json=postdata)
+        return captcha_pool.take(timeout=captcha_pool_timeout)
+    except queue.Empty:
+        raise DelayedRetriableException('No solved captcha available in the pool')
+
+@instrumented('make_download_call', download_outcomes)
+def make_download_call(roll_url, session, postdata, pdf_file):
+    try:
+        resp = limited_call(session.post, roll_url, json=postdata, stream=True)
     except RequestException as ex:
         raise DelayedRetriableException(str(ex))
 
     if not resp.ok:
-        if resp.status_code == 400:
-            data = resp.json()
-            msg = data['message']
-            if msg == 'Invalid Catpcha':
-                raise RetriableException('Failed to solve captcha')
-        if resp.status_code == 401:
-            data = resp.json()
-            msg = data['message']
-            if msg.find('has not been published for this AC') != -1 or \
-               msg.find('not published for this state') != -1:
-                raise ChangeUrlRetriableException(f'Roll not available for {roll_url}')
-        raise_delayed_exception_if_needed(resp)
-        print('\t\t\tWARNING: Failed request - ', resp.text)
-        raise Exception(f'Unable to get roll for part {postdata} at {roll_url}')
-
-    data = resp.json()
-    if data['status'] != 'Success':
-        raise DelayedRetriableException(f'Unable to get roll for part {postdata} at {roll_url}, message: {data["message"]}, status: {data["status"]}')
+        raise_download_error(resp.status_code, resp.text, roll_url, postdata)
 
+    try:
+        data = write_streamed_pdf(resp.iter_content(chunk_size=stream_chunk_size), pdf_file)
+    except RequestException as ex:
+        raise DelayedRetriableException(str(ex))
+    finally:
+        resp.close()
+
+    check_download_data(data, roll_url, postdata)
     return data
 
 
 
+roll_urls = { 'draft': draft_url, 'final': final_url, 'ge': ge_url }
+roll_prefixes = { 'draft': 'd', 'final': 'f', 'ge': '' }
+
+def get_roll_file(lang_dir, roll, partno):
+    return lang_dir / f'{roll_prefixes[roll]}{partno}.pdf'
+
+def get_roll_candidates(scode, acno):
+    # tried from the end, ge first, then final, then draft, leaving out
+    # rolls known not to be published for the state or AC
+    unavailable = get_journal().get_unavailable_rolls(scode, acno)
+    rolls = [ r for r in [ 'draft', 'final', 'ge' ] if r not in unavailable ]
+    if len(rolls) == 0:
+        raise Exception(f'No roll published for constituency {acno} of {scode}')
+    return rolls
+
+def record_unavailable_roll(scode, acno, roll, ex):
+    get_journal().mark_unavailable(scode, None if ex.state_wide else acno, roll)
+
+def find_downloaded_part(lang_dir, scode, acno, lang, partno):
+    journal = get_journal()
+    entry = journal.get_part(scode, acno, lang, partno)
+    if entry is not None and entry['state'] in ('done', 'converted'):
+        pdf_file = get_roll_file(lang_dir, entry['roll'], partno)
+        # the directory may have been archived and removed since
+        if pdf_file.exists():
+            return pdf_file
+
+    for roll in [ 'draft', 'final', 'ge' ]:
+        pdf_file = get_roll_file(lang_dir, roll, partno)
+        if pdf_file.exists():
+            # downloaded before the journal was kept
+            journal.mark_done(scode, acno, lang, partno, roll, pdf_file.stat().st_size)
+            return pdf_file
+    return None
+
+def record_downloaded_part(lang_dir, scode, acno, lang, partno, roll, data):
+    pdf_file = get_roll_file(lang_dir, roll, partno)
+    if data['file'] is None:
+        print(f'\t\t\tWARNING: voter roll not available')
+        pdf_file.write_text('')
+    else:
+        print(f'\t\t\twrote file: {pdf_file}')
+    get_journal().mark_done(scode, acno, lang, partno, roll, pdf_file.stat().st_size)
+    return pdf_file
+
+
+@instrumented('download_part', download_outcomes)
 def download_part(session, lang, part):
 
     acno   = part['acNumber']
@@ -251,27 +460,20 @@ def download_part(session, lang, part):
 
     lang_dir = raw_dir / f'{scode}' / f'{acno}' / f'{lang}'
 
-    ge_pdf_file    = lang_dir / f'{partno}.pdf'
-    draft_pdf_file = lang_dir / f'd{partno}.pdf'
-    final_pdf_file = lang_dir / f'f{partno}.pdf'
-
-
-    roll_urls = [ draft_url, final_url, ge_url ]
-    pdf_files = [ draft_pdf_file, final_pdf_file, ge_pdf_file ]
-    for pdf_file in pdf_files:
-        if pdf_file.exists():
-            return pdf_file
+    pdf_file = find_downloaded_part(lang_dir, scode, acno, lang, partno)
+    if pdf_file is not None:
+        return pdf_file
 
     lang_dir.mkdir(exist_ok=True, parents=True)
 
-    pdf_file = pdf_files.pop()
-    roll_url = roll_urls.pop()
+    journal = get_journal()
+    journal.mark_pending(scode, acno, lang, partno)
+    rolls = get_roll_candidates(scode, acno)
+    roll = rolls.pop()
     while True:
         try:
-            captcha_id, captcha_img = get_captcha(session)
-            captcha_val = solve_captcha(captcha_img)
-            if captcha_val == '':
-                raise RetriableException('Could not solve captcha')
+            journal.record_attempt(scode, acno, lang, partno, roll)
+            captcha_id, captcha_val = get_solved_captcha(session)
 
             postdata = {
                 'acNumber'   : acno,
@@ -283,27 +485,20 @@ def download_part(session, lang, part):
                 'stateCd'    : scode,
             }
 
-            data = make_download_call(roll_url, session, postdata)
+            data = make_download_call(roll_urls[roll], session, postdata,
+                                      get_roll_file(lang_dir, roll, partno))
         except RetriableException as ex:
             print(f'\t\t\tWARNING: {ex}')
             continue
         except ChangeUrlRetriableException as ex:
             print(f'\t\t\tWARNING: {ex}')
-            if len(pdf_files) == 0: 
+            record_unavailable_roll(scode, acno, roll, ex)
+            if len(rolls) == 0: 
                 raise Exception('Unable to get any roll')
-            pdf_file = pdf_files.pop()
-            roll_url = roll_urls.pop()
+            roll = rolls.pop()
             continue
 
-        if data['file'] is None:
-            print(f'\t\t\tWARNING: voter roll not available')
-            pdf_file.write_text('')
-            return pdf_file
-        print(f'\t\t\twriting file: {pdf_file}')
-        content = base64.b64decode(data['file'])
-
-        pdf_file.write_bytes(content)
-        return pdf_file
+        return record_downloaded_part(lang_dir, scode, acno, lang, partno, roll, data)
 
    
 
@@ -324,17 +519,13 @@ def get_priority_map():
         priority_map[code] = i
     return priority_map
 
-def download():
-    global done_set
-    global selected_state_codes
-
+def create_session():
     session = requests.session()
     retry = Retry(
         total=max_attempts,
         read=max_attempts,
         connect=max_attempts,
-        backoff_factor=initial_delay,
-        status_forcelist=set([500]),
+        backoff_factor=retry_delay,
     )
     session.mount('http://', HTTPAdapter(max_retries=retry))
     session.mount('https://', HTTPAdapter(max_retries=retry))
@@ -342,8 +533,70 @@ def download():
     resp = session.get(base_url)
     if not resp.ok:
         raise Exception(f'Unable to get main page at {base_url}')
-    reset_delay()
+    return session
+
+def get_worker_session():
+    # each worker thread keeps its own session and connection pool
+    session = getattr(worker_local, 'session', None)
+    if session is None:
+        session = create_session()
+        worker_local.session = session
+    return session
+
+def download_part_job(lang, part):
+    part_name = part['partName']
+    print(f'\t\thandling lang: {lang}, part: {part_name}')
+    return with_retries(download_part, get_worker_session(), lang, part)
+
+def wait_for_disk():
+    if min_free_disk_mb <= 0:
+        return
+    while True:
+        free_mb = shutil.disk_usage(data_dir).free // (1024 * 1024)
+        if free_mb >= min_free_disk_mb:
+            return
+        print(f'\t\t\tWARNING: only {free_mb} MB free on disk, waiting for conversions and archives to catch up')
+        time.sleep(disk_check_interval)
+
+def queue_for_conversion(pdf_file):
+    emit_event('downloaded', pdf_file)
+    send_q.put(str(pdf_file))
+
+def collect_parts(executor, jobs):
+    # yields (lang, pdf_file) for the (lang, part) jobs in order, with at most
+    # num_workers + send_q_size of them submitted at a time, so the workers
+    # stall along with the converters and the disk check instead of running
+    # through the whole constituency
+    jobs = iter(jobs)
+    window = deque()
+    while True:
+        while len(window) < num_workers + send_q_size:
+            job = next(jobs, None)
+            if job is None:
+                break
+            wait_for_disk()
+            window.append((job[0], executor.submit(download_part_job, *job)))
+        if len(window) == 0:
+            return
+        lang, future = window.popleft()
+        pdf_file = future.result()
+        queue_for_conversion(pdf_file)
+        reset_delay()
+        yield lang, pdf_file
+
+def download_parts(session, lang, parts):
+    pdf_files = []
+    for part in parts:
+        part_name = part['partName']
+        print(f'\t\thandling lang: {lang}, part: {part_name}')
+        wait_for_disk()
+        pdf_file = with_retries(download_part, session, lang, part)
+        pdf_files.append(pdf_file)
+        queue_for_conversion(pdf_file)
+        reset_delay()
+    return pdf_files
 
+def get_selected_states(session):
     state_list = get_state_list(session)
     state_map = { x['stateCd']:x for x in state_list } 
     reset_delay()
@@ -354,52 +607,144 @@ def download():
         state_list.sort(key=lambda x: priority_map[x['stateCd']])
     else:
         state_list = [ state_map[k] for k in selected_state_codes ]
+    return state_list
 
 
+def download():
+    global done_set
+    global selected_state_codes
+    global seed_coordinator
+
+    session = create_session()
+    reset_delay()
+
+    if coordinator is None or seed_coordinator:
+        state_list = get_selected_states(session)
+
+    executor = None
+    if num_workers > 1:
+        executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        if coordinator is None:
+            download_states(session, executor, state_list)
+            return
+        if seed_coordinator:
+            seed_jobs(session, state_list)
+            seed_coordinator = False
+        download_leased_jobs(session, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def finish_lang(scode, acno, lang, pdf_files):
+    # to make archive management uniform.. just leave an empty dir when all files are empty
+    all_empty = all([ p.exists() and p.stat().st_size == 0 for p in pdf_files ])
+    if all_empty:
+        lang_dir = Path('data/pages/') / f'{scode}' / f'{acno}' / f'{lang}'
+        lang_dir.mkdir(exist_ok=True, parents=True)
+    get_journal().mark_lang_downloaded(scode, acno, lang, len(pdf_files))
+    done_set.add((str(scode), str(acno), lang))
+
+def get_pending_langs(scode, acno, langs, finished_langs):
+    return [ lang for lang in langs
+             if (str(scode), str(acno), lang) not in done_set and (str(acno), lang) not in finished_langs ]
+
+
+def download_states(session, executor, state_list):
     for state_info in state_list:
         scode = state_info['stateCd']
         sname = state_info['stateName']
         print(f'handling state: {sname}')
   
-        district_list = get_district_list(session, scode)
+        district_list = with_retries(get_district_list, session, scode)
         reset_delay()
-        constituency_list = get_constituency_list(session, scode)
+        constituency_list = with_retries(get_constituency_list, session, scode)
         reset_delay()
+        # languages finished by an earlier run are skipped without loading their parts
+        finished_langs = get_journal().get_finished_langs(scode)
         for constituency_info in constituency_list:
             acname = constituency_info['asmblyName']
             acno   = constituency_info['asmblyNo']
+            langs = with_retries(get_constituency_langs, session, constituency_info)
+            reset_delay()
+            langs = get_pending_langs(scode, acno, langs, finished_langs)
+            if len(langs) == 0:
+                continue
             print(f'\thandling constituency: {acname}')
-            langs = get_constituency_langs(session, constituency_info)
+            parts = with_retries(get_constituency_parts, session, constituency_info)
             reset_delay()
-            parts = get_constituency_parts(session, constituency_info)
+            if executor is None:
+                for lang in langs:
+                    finish_lang(scode, acno, lang, download_parts(session, lang, parts))
+                continue
+            # the (lang, part) jobs of the constituency run as one stream so the
+            # workers don't wait on language boundaries
+            jobs = [ (lang, part) for lang in langs for part in parts ]
+            pdf_files = { lang: [] for lang in langs }
+            for lang, pdf_file in collect_parts(executor, jobs):
+                pdf_files[lang].append(pdf_file)
+                if len(pdf_files[lang]) == len(parts):
+                    finish_lang(scode, acno, lang, pdf_files[lang])
+            if len(parts) == 0:
+                for lang in langs:
+                    finish_lang(scode, acno, lang, [])
+
+
+def seed_jobs(session, state_list):
+    for state_info in state_list:
+        scode = state_info['stateCd']
+        print(f'seeding jobs for state: {state_info["stateName"]}')
+        constituency_list = with_retries(get_constituency_list, session, scode)
+        reset_delay()
+        jobs = []
+        for constituency_info in constituency_list:
+            acno = constituency_info['asmblyNo']
+            langs = with_retries(get_constituency_langs, session, constituency_info)
             reset_delay()
-            for lang in langs:
-                if (str(scode), str(acno), lang) in done_set:
-                    continue
-                pdf_files = []
-                for part in parts:
-                    part_name = part['partName']
-                    print(f'\t\thandling lang: {lang}, part: {part_name}')
-                    pdf_file = download_part(session, lang, part)
-                    pdf_files.append(pdf_file)
-                    send_q.put(str(pdf_file))
+            jobs.extend([ (scode, acno, lang) for lang in langs ])
+        coordinator.seed(jobs)
+
+
+def download_leased_jobs(session, executor):
+    worker = f'{socket.gethostname()}-{os.getpid()}'
+    while True:
+        job = coordinator.claim(worker)
+        if job is None:
+            print(f'no more jobs to claim, {coordinator.get_counts()}')
+            return
+        scode, acno, lang = job
+        print(f'\thandling job: {scode}/{acno}/{lang}')
+        try:
+            with LeaseKeeper(coordinator, job, worker):
+                finished_langs = get_journal().get_finished_langs(scode)
+                if len(get_pending_langs(scode, acno, [ lang ], finished_langs)) != 0:
+                    with_retries(get_constituency_list, session, scode)
                     reset_delay()
-                # to make archive management uniform.. just leave an empty dir when all files are empty
-                all_empty = all([ p.exists() and p.stat().st_size == 0 for p in pdf_files ])
-                if all_empty:
-                    lang_dir = Path('data/pages/') / f'{scode}' / f'{acno}' / f'{lang}'
-                    lang_dir.mkdir(exist_ok=True, parents=True)
-                done_set.add((str(scode), str(acno), lang))
-                    
-
-def populate_done_set():
-    keys = get_bucket_keys('indian-electoral-rolls')
-    for key in keys:
-        parts = key.split('/')
-        scode = parts[0]
-        acno  = parts[1]
-        lang  = parts[2][:-4]
-        done_set.add((scode, acno, lang))
+                    constituency_info = get_metadata().get_constituency(scode, acno)
+                    parts = with_retries(get_constituency_parts, session, constituency_info)
+                    reset_delay()
+                    if executor is None:
+                        pdf_files = download_parts(session, lang, parts)
+                    else:
+                        jobs = [ (lang, part) for part in parts ]
+                        pdf_files = [ pdf_file for _, pdf_file in collect_parts(executor, jobs) ]
+                    finish_lang(scode, acno, lang, pdf_files)
+        except BaseException:
+            # let some other box pick it up instead of waiting out the lease
+            coordinator.release(job, worker)
+            raise
+        coordinator.complete(job, worker)
+
+
+def populate_done_set(reconcile=False):
+    reconcile_manifest('indian-electoral-rolls', force=reconcile)
+    done_set.update(get_manifest().get_done_set('indian-electoral-rolls'))
+
+def mark_part_converted(pdf_file):
+    lang_dir = pdf_file.parent
+    partno = int(pdf_file.name[:-4].lstrip('df'))
+    get_journal().mark_converted(lang_dir.parent.parent.name, lang_dir.parent.name, lang_dir.name, partno)
 
 def converter_runner():
     while True:
@@ -409,8 +754,33 @@ def converter_runner():
             break
         pdf_file = Path(fname)
         print(f'\t\tconverting file {pdf_file}')
-        convert_to_pages(pdf_file)
-        send_q.task_done()
+        try:
+            convert_to_pages(pdf_file, encoder=webp_encoder, level=webp_level)
+            mark_part_converted(pdf_file)
+            emit_event('converted', pdf_file)
+        except Exception:
+            # the pdf stays on disk and gets converted by a later run
+            print(f'ERROR: conversion of {pdf_file} failed')
+            traceback.print_exc()
+        finally:
+            send_q.task_done()
+
+def start_converters():
+    global send_q
+    send_q = queue.Queue(maxsize=send_q_size)
+    converter_threads = [ threading.Thread(target=converter_runner, daemon=True) for i in range(num_converters) ]
+    for thread in converter_threads:
+        thread.start()
+    return converter_threads
+
+def stop_converters(converter_threads):
+    # everything queued so far is converted before the workers are told
+    # to stop, one sentinel each
+    send_q.join()
+    for thread in converter_threads:
+        send_q.put('DONE')
+    for thread in converter_threads:
+        thread.join()
 
 def reset_delay():
     global try_count
@@ -420,29 +790,75 @@ def reset_delay():
 
 
 if __name__ == '__main__':
-    import sys
-    selected_state_codes = sys.argv[1:]
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('state_codes', nargs='*')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of parts to download concurrently')
+    parser.add_argument('--captcha-backend', choices=['tesseract', 'knn'], default='tesseract',
+                        help='knn needs a model trained with captcha/train.py')
+    parser.add_argument('--min-captcha-confidence', type=float, default=min_captcha_confidence,
+                        help='skip captchas solved with a lower per character confidence, 0 turns the threshold off')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='refresh the local manifest from a full bucket listing')
+    parser.add_argument('--captcha-pool', type=int, default=0,
+                        help='number of solved captchas to keep ready, 0 solves them inline')
+    parser.add_argument('--captcha-pool-threads', type=int, default=2)
+    parser.add_argument('--captcha-ttl', type=int, default=60,
+                        help='seconds after which a pooled captcha is dropped')
+    parser.add_argument('--converters', type=int, default=num_converters,
+                        help='number of pdfs converted concurrently')
+    add_webp_args(parser)
+    parser.add_argument('--queue-size', type=int, default=send_q_size,
+                        help='downloaded pdfs allowed to wait for conversion')
+    parser.add_argument('--min-free-disk-mb', type=int, default=min_free_disk_mb,
+                        help='pause downloads below this much free disk, 0 turns the check off')
+    parser.add_argument('--coordinator',
+                        help='sqlite file of a shared job queue to lease (state, AC, lang) jobs from')
+    parser.add_argument('--seed', action='store_true',
+                        help='add the jobs of the selected states to the coordinator queue first')
+    parser.add_argument('--lease-timeout', type=int, default=600,
+                        help='seconds without a heartbeat after which a leased job is handed out again')
+    metrics.add_metrics_args(parser)
+    args = parser.parse_args()
+    selected_state_codes = args.state_codes
+    num_workers = args.workers
+    num_converters = args.converters
+    webp_encoder = args.webp_encoder
+    webp_level = args.webp_level
+    send_q_size = args.queue_size
+    min_free_disk_mb = args.min_free_disk_mb
+    if args.coordinator is not None:
+        coordinator = Coordinator(args.coordinator, args.lease_timeout)
+        seed_coordinator = args.seed
+    captcha_backend = args.captcha_backend
+    min_captcha_confidence = args.min_captcha_confidence
+    if args.captcha_pool > 0:
+        captcha_pool = CaptchaPool(fill_captcha_pool, args.captcha_pool,
+                                   args.captcha_ttl, args.captcha_pool_threads)
+        captcha_pool.start()
+    metrics.send_queue_depth.set_function(lambda: send_q.qsize())
+    metrics.start_metrics(args)
     raw_dir.mkdir(exist_ok=True, parents=True)
     print('collecting existing constituency list')
-    populate_done_set()
+    populate_done_set(args.reconcile)
 
-    converter_thread = threading.Thread(target=converter_runner, daemon=True)
-    converter_thread.start()
-    while True:
-        try:
-            download()
-            break
-        except DelayedRetriableException as ex:
-            print(f'WARNING: {ex}..')
-            if try_count > max_attempts:
-                raise Exception('Unable to retrieve data')
-            print(f'WARNING: sleeping for {curr_delay} before attempting again')
-            time.sleep(curr_delay)
-            try_count += 1
-            curr_delay *= 2
-            continue
-    send_q.put('DONE')
-    converter_thread.join()
-    send_q.join()
+    converter_threads = start_converters()
+    try:
+        while True:
+            try:
+                download()
+                break
+            except DelayedRetriableException as ex:
+                print(f'WARNING: {ex}..')
+                if try_count > max_attempts:
+                    raise Exception('Unable to retrieve data')
+                print(f'WARNING: sleeping for {curr_delay} before attempting again')
+                time.sleep(curr_delay)
+                try_count += 1
+                curr_delay *= 2
+                continue
+    finally:
+        stop_converters(converter_threads)
 
 
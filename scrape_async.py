@@ -0,0 +1,396 @@
+import os
+import json
+import time
+import asyncio
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import httpx
+
+import scrape
+from scrape import (base_url, raw_dir, tmp_dir, stream_chunk_size, captcha_url, lang_url, part_list_url,
+                    RetriableException, DelayedRetriableException,
+                    ChangeUrlRetriableException, parse_listing_response, parse_captcha_response,
+                    raise_download_error, check_download_data, check_captcha_confidence,
+                    endpoint_names, download_outcomes, solve_outcomes)
+from captcha.solve import solve_captcha_bytes
+from ratelimit import get_bucket
+from utils import Base64FieldDecoder, add_webp_args
+from metadata import get_metadata
+from journal import get_journal
+import metrics
+from metrics import instrumented
+
+max_attempts = scrape.max_attempts
+retry_delay = scrape.retry_delay
+
+request_timeout = 120
+
+# parts finished by this process, a restart that moved it on gets a fresh
+# retry budget like the threaded crawler's reset_delay
+parts_done = 0
+
+
+async def limited_call(method, url, **kwargs):
+    bucket = get_bucket(url)
+    if bucket is None:
+        return await method(url, **kwargs)
+    await bucket.acquire_async()
+    start = time.monotonic()
+    try:
+        resp = await method(url, **kwargs)
+    except httpx.HTTPError:
+        bucket.record_failure()
+        raise
+    latency = time.monotonic() - start
+    bucket.record(resp.status_code, latency)
+    metrics.record_response(endpoint_names.get(url, url), resp.status_code, latency)
+    return resp
+
+
+async def get_constituency_langs(client, c_info):
+    scode = c_info['stateCd']
+    dcode = c_info['districtCd']
+    acno  = c_info['asmblyNo']
+
+    c_dir = raw_dir / f'{scode}' / f'{acno}'
+    c_dir.mkdir(exist_ok=True, parents=True)
+
+    lang_file = c_dir / 'langs.json'
+    langs = get_metadata().get_langs(scode, acno)
+    if langs is not None:
+        return langs
+
+    postdata = { 'acNumber': acno, 'districtCd': dcode, 'stateCd': scode }
+    try:
+        resp = await limited_call(client.post, lang_url, json=postdata)
+    except httpx.HTTPError as ex:
+        raise DelayedRetriableException(str(ex))
+
+    langs = parse_listing_response(resp.status_code, resp.text,
+                                   f'language list for constituency {acno} of {scode}', lang_url)
+
+    lang_file.write_text(json.dumps(langs))
+
+    return langs
+
+
+async def get_constituency_parts(client, c_info):
+    scode = c_info['stateCd']
+    dcode = c_info['districtCd']
+    acno  = c_info['asmblyNo']
+
+    c_dir = raw_dir / f'{scode}' / f'{acno}'
+    c_dir.mkdir(exist_ok=True, parents=True)
+
+    parts_file = c_dir / 'parts.json'
+    parts = get_metadata().get_parts(scode, acno)
+    if parts is not None:
+        return parts
+
+    postdata = { 'acNumber': acno, 'districtCd': dcode, 'stateCd': scode }
+    try:
+        resp = await limited_call(client.post, part_list_url, json=postdata)
+    except httpx.HTTPError as ex:
+        raise DelayedRetriableException(str(ex))
+
+    parts = parse_listing_response(resp.status_code, resp.text,
+                                   f'parts list for constituency {acno} of {scode}', part_list_url)
+
+    parts_file.write_text(json.dumps(parts))
+
+    return parts
+
+
+@instrumented('get_captcha', [ (DelayedRetriableException, 'retry') ])
+async def get_captcha(client):
+    try:
+        resp = await limited_call(client.get, captcha_url)
+    except httpx.HTTPError as ex:
+        raise DelayedRetriableException(str(ex))
+
+    return parse_captcha_response(resp.status_code, resp.text)
+
+
+async def write_streamed_pdf(chunks, pdf_file):
+    tmp_dir.mkdir(exist_ok=True, parents=True)
+    fd, tmp_name = tempfile.mkstemp(dir=tmp_dir, suffix='.pdf')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            decoder = Base64FieldDecoder('file', f)
+            async for chunk in chunks:
+                decoder.feed(chunk)
+            data = decoder.close()
+        if data['status'] == 'Success' and data.get('file', None) is not None:
+            os.replace(tmp_name, pdf_file)
+            metrics.downloaded_bytes_total.inc(pdf_file.stat().st_size)
+    finally:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+    return data
+
+
+@instrumented('solve_captcha', solve_outcomes)
+async def solve_captcha_gated(solver, captcha_bytes):
+    # solving is cpu bound, keep it off the event loop
+    loop = asyncio.get_running_loop()
+    solution = await loop.run_in_executor(solver, solve_captcha_bytes, captcha_bytes,
+                                          scrape.captcha_backend)
+    return check_captcha_confidence(solution)
+
+
+@instrumented('make_download_call', download_outcomes)
+async def make_download_call(roll_url, client, postdata, pdf_file):
+    bucket = get_bucket(roll_url)
+    await bucket.acquire_async()
+    start = time.monotonic()
+    try:
+        async with client.stream('POST', roll_url, json=postdata) as resp:
+            latency = time.monotonic() - start
+            bucket.record(resp.status_code, latency)
+            metrics.record_response(endpoint_names[roll_url], resp.status_code, latency)
+            if not resp.is_success:
+                await resp.aread()
+                raise_download_error(resp.status_code, resp.text, roll_url, postdata)
+
+            data = await write_streamed_pdf(resp.aiter_bytes(stream_chunk_size), pdf_file)
+    except httpx.HTTPError as ex:
+        bucket.record_failure()
+        raise DelayedRetriableException(str(ex))
+
+    check_download_data(data, roll_url, postdata)
+    return data
+
+
+async def download_part(client, solver, lang, part):
+
+    acno   = part['acNumber']
+    partno = part['partNumber']
+    scode  = part['stateCd'].upper()
+    dcode  = part['districtCd'].upper()
+
+    lang_dir = raw_dir / f'{scode}' / f'{acno}' / f'{lang}'
+
+    # journal reads and writes can wait on the sqlite lock, keep them off the event loop
+    pdf_file = await asyncio.to_thread(scrape.find_downloaded_part, lang_dir, scode, acno, lang, partno)
+    if pdf_file is not None:
+        return pdf_file
+
+    lang_dir.mkdir(exist_ok=True, parents=True)
+
+    journal = get_journal()
+    await asyncio.to_thread(journal.mark_pending, scode, acno, lang, partno)
+    rolls = await asyncio.to_thread(scrape.get_roll_candidates, scode, acno)
+    roll = rolls.pop()
+    while True:
+        try:
+            await asyncio.to_thread(journal.record_attempt, scode, acno, lang, partno, roll)
+            captcha_id, captcha_bytes = await get_captcha(client)
+            captcha_val = await solve_captcha_gated(solver, captcha_bytes)
+
+            postdata = {
+                'acNumber'   : acno,
+                'captcha'    : captcha_val,
+                'captchaId'  : captcha_id,
+                'districtCd' : dcode,
+                'langCd'     : lang,
+                'partNumber' : partno,
+                'stateCd'    : scode,
+            }
+
+            data = await make_download_call(scrape.roll_urls[roll], client, postdata,
+                                            scrape.get_roll_file(lang_dir, roll, partno))
+        except RetriableException as ex:
+            print(f'\t\t\tWARNING: {ex}')
+            continue
+        except ChangeUrlRetriableException as ex:
+            print(f'\t\t\tWARNING: {ex}')
+            await asyncio.to_thread(scrape.record_unavailable_roll, scode, acno, roll, ex)
+            if len(rolls) == 0:
+                raise Exception('Unable to get any roll')
+            roll = rolls.pop()
+            continue
+
+        return await asyncio.to_thread(scrape.record_downloaded_part, lang_dir, scode, acno, lang, partno, roll, data)
+
+
+async def with_retries(fn, *args):
+    delay = retry_delay
+    attempt = 1
+    while True:
+        try:
+            return await fn(*args)
+        except DelayedRetriableException as ex:
+            print(f'WARNING: {ex}..')
+            if attempt >= max_attempts:
+                # the whole crawl backs off and restarts, see run_download
+                raise ex
+            print(f'WARNING: sleeping for {delay} before attempting again')
+            await asyncio.sleep(delay)
+            attempt += 1
+            delay *= 2
+
+
+class LangTracker:
+    def __init__(self, scode, acno, lang, count):
+        self.scode = scode
+        self.acno = acno
+        self.lang = lang
+        self.remaining = count
+        self.pdf_files = []
+
+    async def part_done(self, pdf_file):
+        self.pdf_files.append(pdf_file)
+        self.remaining -= 1
+        if self.remaining > 0:
+            return
+        # writes to the journal and touches the disk
+        await asyncio.to_thread(scrape.finish_lang, self.scode, self.acno, self.lang, self.pdf_files)
+
+
+async def produce_jobs(client, session, job_q, state_list, num_consumers):
+    for state_info in state_list:
+        scode = state_info['stateCd']
+        sname = state_info['stateName']
+        print(f'handling state: {sname}')
+
+        # district and constituency lists are cached on disk, the blocking session is enough
+        await asyncio.to_thread(scrape.get_district_list, session, scode)
+        constituency_list = await asyncio.to_thread(scrape.get_constituency_list, session, scode)
+        # languages finished by an earlier run are skipped without loading their parts
+        finished_langs = await asyncio.to_thread(get_journal().get_finished_langs, scode)
+        for constituency_info in constituency_list:
+            acname = constituency_info['asmblyName']
+            acno   = constituency_info['asmblyNo']
+            langs = await with_retries(get_constituency_langs, client, constituency_info)
+            langs = scrape.get_pending_langs(scode, acno, langs, finished_langs)
+            if len(langs) == 0:
+                continue
+            print(f'\thandling constituency: {acname}')
+            parts = await with_retries(get_constituency_parts, client, constituency_info)
+            for lang in langs:
+                if len(parts) == 0:
+                    continue
+                tracker = LangTracker(scode, acno, lang, len(parts))
+                for part in parts:
+                    # blocks when the consumers are behind, keeps priority order intact
+                    await job_q.put((tracker, part))
+
+    for i in range(num_consumers):
+        await job_q.put(None)
+
+
+async def consume_jobs(client, solver, job_q):
+    global parts_done
+    while True:
+        job = await job_q.get()
+        if job is None:
+            break
+        tracker, part = job
+        part_name = part['partName']
+        print(f'\t\thandling lang: {tracker.lang}, part: {part_name}')
+        await asyncio.to_thread(scrape.wait_for_disk)
+        pdf_file = await with_retries(download_part, client, solver, tracker.lang, part)
+        # blocks while the converters are behind, keep it off the event loop
+        await asyncio.to_thread(scrape.queue_for_conversion, pdf_file)
+        parts_done += 1
+        await tracker.part_done(pdf_file)
+
+
+async def download(selected_state_codes, concurrency, solver_procs):
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+    timeout = httpx.Timeout(request_timeout)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        resp = await client.get(base_url)
+        if not resp.is_success:
+            raise Exception(f'Unable to get main page at {base_url}')
+
+        session = await asyncio.to_thread(scrape.create_session)
+        state_list = await asyncio.to_thread(scrape.get_state_list, session)
+        state_map = { x['stateCd']:x for x in state_list }
+
+        if len(selected_state_codes) == 0:
+            priority_map = scrape.get_priority_map()
+            state_list = [ x for x in state_list if x['stateCd'] in priority_map ]
+            state_list.sort(key=lambda x: priority_map[x['stateCd']])
+        else:
+            state_list = [ state_map[k] for k in selected_state_codes ]
+
+        with ProcessPoolExecutor(max_workers=solver_procs) as solver:
+            job_q = asyncio.Queue(maxsize=concurrency * 2)
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(produce_jobs(client, session, job_q, state_list, concurrency))
+                for i in range(concurrency):
+                    tg.create_task(consume_jobs(client, solver, job_q))
+
+
+def run_download(state_codes, concurrency, solver_procs):
+    # returns the error when the gateway kept failing past max_attempts
+    delayed = None
+    try:
+        asyncio.run(download(state_codes, concurrency, solver_procs))
+    except* DelayedRetriableException as eg:
+        delayed = eg.exceptions[0]
+    return delayed
+
+
+if __name__ == '__main__':
+    import argparse
+    from multiprocessing import cpu_count
+    parser = argparse.ArgumentParser()
+    parser.add_argument('state_codes', nargs='*')
+    parser.add_argument('--concurrency', type=int, default=200,
+                        help='number of captcha+download exchanges kept in flight')
+    parser.add_argument('--solver-procs', type=int, default=cpu_count(),
+                        help='number of processes solving captchas')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='refresh the local manifest from a full bucket listing')
+    parser.add_argument('--captcha-backend', choices=['tesseract', 'knn'], default='tesseract',
+                        help='knn needs a model trained with captcha/train.py')
+    parser.add_argument('--min-captcha-confidence', type=float, default=scrape.min_captcha_confidence,
+                        help='skip captchas solved with a lower per character confidence, 0 turns the threshold off')
+    parser.add_argument('--converters', type=int, default=scrape.num_converters,
+                        help='number of pdfs converted concurrently')
+    add_webp_args(parser)
+    parser.add_argument('--queue-size', type=int, default=scrape.send_q_size,
+                        help='downloaded pdfs allowed to wait for conversion')
+    parser.add_argument('--min-free-disk-mb', type=int, default=scrape.min_free_disk_mb,
+                        help='pause downloads below this much free disk, 0 turns the check off')
+    metrics.add_metrics_args(parser)
+    args = parser.parse_args()
+    scrape.captcha_backend = args.captcha_backend
+    scrape.min_captcha_confidence = args.min_captcha_confidence
+    scrape.num_converters = args.converters
+    scrape.webp_encoder = args.webp_encoder
+    scrape.webp_level = args.webp_level
+    scrape.send_q_size = args.queue_size
+    scrape.min_free_disk_mb = args.min_free_disk_mb
+    # start_converters replaces the queue, so look it up on every render
+    metrics.send_queue_depth.set_function(lambda: scrape.send_q.qsize())
+    metrics.start_metrics(args)
+    raw_dir.mkdir(exist_ok=True, parents=True)
+    print('collecting existing constituency list')
+    scrape.populate_done_set(args.reconcile)
+
+    converter_threads = scrape.start_converters()
+    try_count = 1
+    curr_delay = scrape.initial_delay
+    try:
+        while True:
+            done_before = parts_done
+            ex = run_download(args.state_codes, args.concurrency, args.solver_procs)
+            if ex is None:
+                break
+            print(f'WARNING: {ex}..')
+            if parts_done != done_before:
+                try_count = 1
+                curr_delay = scrape.initial_delay
+            if try_count > max_attempts:
+                raise Exception('Unable to retrieve data')
+            print(f'WARNING: sleeping for {curr_delay} before attempting again')
+            time.sleep(curr_delay)
+            try_count += 1
+            curr_delay *= 2
+    finally:
+        scrape.stop_converters(converter_threads)
@@ -1,18 +1,32 @@
 import io
+import os
+import re
+import hashlib
+import time
+import math
+import mmap
 import sys
+import base64
 import threading
 import json
 import subprocess
 import shutil
-from multiprocessing import Pool, cpu_count
+import tarfile
+from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
 import boto3
-from boto3.s3.transfer import TransferConfig
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
 
 from pypdf import PdfReader
 from PIL import Image
 
+from manifest import get_manifest
+import metrics
+from metrics import instrumented
+
 
 def run_external(cmd):
     #print(f'running cmd - {cmd}')
@@ -32,6 +46,82 @@ def convert_to_webp(arg):
         raise ex
     png_file.unlink()
 
+class Base64FieldDecoder:
+    # pulls a single base64 string field out of a json document as it streams in
+    # and decodes it into out_file, the rest of the document is kept and parsed
+    # at the end with the field replaced by true ( or left as null )
+    def __init__(self, field, out_file):
+        self.field_re = re.compile(rb'"' + field.encode() + rb'"\s*:\s*("|null)')
+        self.out_file = out_file
+        self.state = 'head'
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.pending = b''
+        self.size = 0
+
+    def decode(self, b64_bytes):
+        b64_bytes = self.pending + b64_bytes.replace(b'\\', b'')
+        usable = len(b64_bytes) - len(b64_bytes) % 4
+        self.pending = b64_bytes[usable:]
+        content = base64.b64decode(b64_bytes[:usable])
+        self.out_file.write(content)
+        self.size += len(content)
+
+    def feed(self, chunk):
+        if self.state == 'head':
+            self.head.extend(chunk)
+            match = self.field_re.search(self.head)
+            if match is None:
+                return
+            if match.group(1) == b'null':
+                self.state = 'tail'
+                return
+            rest = bytes(self.head[match.end():])
+            del self.head[match.start(1):]
+            self.head.extend(b'true')
+            self.state = 'value'
+            chunk = rest
+
+        if self.state == 'value':
+            idx = chunk.find(b'"')
+            if idx == -1:
+                self.decode(chunk)
+                return
+            self.decode(chunk[:idx])
+            chunk = chunk[idx+1:]
+            self.state = 'tail'
+            self.tail.extend(chunk)
+            return
+
+        self.tail.extend(chunk)
+
+    def close(self):
+        if self.state == 'value':
+            raise Exception('truncated base64 field')
+        if len(self.pending) != 0:
+            raise Exception('incomplete base64 data')
+        return json.loads(bytes(self.head + self.tail))
+
+
+# (method, quality) used by cwebp for each of its -z 0..9 lossless levels
+lossless_presets = [ (0, 0), (1, 20), (2, 25), (3, 30), (3, 50),
+                     (4, 50), (4, 75), (4, 90), (5, 90), (6, 100) ]
+
+webp_encoder = 'pillow'
+webp_lossless_level = 9
+
+def add_webp_args(parser):
+    parser.add_argument('--webp-encoder', choices=['pillow', 'cwebp'], default=webp_encoder,
+                        help='encode pages in process with pillow or by running cwebp')
+    parser.add_argument('--webp-level', type=int, choices=range(len(lossless_presets)),
+                        default=webp_lossless_level, metavar='0-9',
+                        help='lossless effort level, same as cwebp -z, only used by the pillow encoder')
+
+def save_webp(img, webp_file, level):
+    # in process equivalent of 'cwebp -lossless -z <level>'
+    method, quality = lossless_presets[level]
+    img.save(webp_file, 'WEBP', lossless=True, quality=quality, method=method)
+
 def get_alt_dir(file, alt):
     parents = list(file.parents)
     parents.reverse()
@@ -42,41 +132,99 @@ def get_alt_dir(file, alt):
     alt_dir = base_dir.joinpath(*([alt] + pieces[rindex+1:] + [file.name[:-4]]))
     return alt_dir
 
-def extract_images_from_pdf(file, pages_dir, num_procs):
+class ConversionExecutor:
+    # long lived process pool shared by every pdf converted in a run, submit
+    # blocks once max_pending page jobs are outstanding
+    def __init__(self, num_procs, max_pending):
+        self.executor = ProcessPoolExecutor(max_workers=num_procs)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def job_done(self, future):
+        with self.lock:
+            self.pending -= 1
+            metrics.conversion_pending.set(self.pending)
+        self.slots.release()
+
+    def submit(self, fn, arg):
+        self.slots.acquire()
+        with self.lock:
+            self.pending += 1
+            metrics.conversion_pending.set(self.pending)
+        future = self.executor.submit(fn, arg)
+        future.add_done_callback(self.job_done)
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+conversion_executor = None
+conversion_executor_lock = threading.Lock()
+
+def get_conversion_executor(num_procs):
+    # the first caller decides the pool size for the whole run
+    global conversion_executor
+    with conversion_executor_lock:
+        if conversion_executor is None:
+            conversion_executor = ConversionExecutor(num_procs, num_procs * 4)
+    return conversion_executor
+
+
+def convert_page_range(arg):
+    # runs in the conversion workers, each of them maps the pdf instead of
+    # getting a copy of it and only decodes the pages it was handed
+    pdf_file, start, end, pages_dir, encoder, level = arg
+    with open(pdf_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        reader = PdfReader(mm)
+        for idx in range(start, end):
+            pno = idx + 1
+            images = reader.pages[idx].images
+            num_images = len(images)
+            if num_images != 1:
+                raise Exception(f'Found {num_images} on {pno}')
+
+            page_file = pages_dir / f'{pno}.webp'
+            if encoder == 'pillow':
+                # decoded pixels go straight to the encoder, no png round trip
+                save_webp(images[0].image, page_file, level)
+            else:
+                # flate streams come out as png and dct ones as the original jpeg bytes
+                page_png_file = pages_dir / f'{pno}.png'
+                print(f'\t\t\t\twriting page - {pno}')
+                page_png_file.write_bytes(images[0].data)
+                convert_to_webp((page_png_file, page_file))
+    return end - start
+
+
+def extract_images_from_pdf(file, pages_dir, num_procs, encoder=webp_encoder, level=webp_lossless_level):
     pages_dir.mkdir(exist_ok=True, parents=True)
-    reader = PdfReader(file)
-    pno = 1
-    page_png_files = []
-    page_files = []
-    for page in reader.pages:
-        images = page.images
-        num_images = len(images)
-        if num_images != 1:
-            raise Exception(f'Found {num_images} on {pno}')
-
-        page_png_file = pages_dir / f'{pno}.png'
-        page_file = pages_dir / f'{pno}.webp'
-        print(f'\t\t\t\twriting page - {pno}')
-        page_png_file.write_bytes(images[0].data)
-        page_png_files.append(page_png_file)
-        page_files.append(page_file)
-        pno += 1
-
-    args = zip(page_png_files, page_files)
+    num_pages = len(PdfReader(file).pages)
     if num_procs == -1:
-        for arg in args:
-            convert_to_webp(arg)
-    else:
-        with Pool(num_procs) as pool:
-            results = pool.map(convert_to_webp, args)
+        convert_page_range((file, 0, num_pages, pages_dir, encoder, level))
+        return num_pages
+
+    executor = get_conversion_executor(num_procs)
+    shard_size = max(1, math.ceil(num_pages / num_procs))
+    futures = []
+    for start in range(0, num_pages, shard_size):
+        end = min(start + shard_size, num_pages)
+        futures.append(executor.submit(convert_page_range, (file, start, end, pages_dir, encoder, level)))
 
+    for future in futures:
+        future.result()
+    return num_pages
 
-def convert_to_pages(pdf_file, num_procs=cpu_count()*2):
+
+@instrumented('convert_to_pages')
+def convert_to_pages(pdf_file, num_procs=cpu_count()*2, encoder=webp_encoder, level=webp_lossless_level):
     sz = pdf_file.stat().st_size
     if sz <= 4:
         return
     pages_dir = get_alt_dir(pdf_file, 'pages')
-    extract_images_from_pdf(pdf_file, pages_dir, num_procs)
+    num_pages = extract_images_from_pdf(pdf_file, pages_dir, num_procs, encoder, level)
+    metrics.pages_converted_total.inc(num_pages)
     pdf_file.write_text('DONE')
 
 
@@ -98,36 +246,69 @@ class ProgressDownloadPercentage(object):
 
 
 
-class ProgressPercentage(object):
-    def __init__(self, filename):
-        self._filename = filename
-        self._size = float(Path(filename).stat().st_size)
-        self._seen_so_far = 0
-        self._lock = threading.Lock()
-
-    def __call__(self, bytes_amount):
-        with self._lock:
-            self._seen_so_far += bytes_amount
-            percentage = (self._seen_so_far / self._size) * 100
-            sys.stdout.write(
-                "\r%s  %s / %s  (%.2f%%)" % (
-                    self._filename, self._seen_so_far, self._size,
-                    percentage))
-            sys.stdout.flush()
-
+MULTIPART_CHUNK_SIZE_MB = 100
+# parts in flight across all transfers, the connection pool is sized to match
+TRANSFER_MAX_CONCURRENCY = 20
+max_concurrent_uploads = 4
 
 boto_client = None
 def get_boto_client():
     global boto_client
     if boto_client is None:
         config = json.loads(Path('infra/r2_credentials.json').read_text())
+        # every api call, including each upload_part, is retried on its own
+        client_config = Config(retries={ 'max_attempts': 10, 'mode': 'adaptive' },
+                               max_pool_connections=TRANSFER_MAX_CONCURRENCY + 8)
         boto_client = boto3.client('s3',
                                    endpoint_url = f'https://{config["accountid"]}.r2.cloudflarestorage.com',
                                    aws_access_key_id = config['access_key_id'],
-                                   aws_secret_access_key = config['access_key_secret'])
+                                   aws_secret_access_key = config['access_key_secret'],
+                                   config = client_config)
     return boto_client
 
-
+transfer_config = TransferConfig(multipart_threshold=1024*1024*MULTIPART_CHUNK_SIZE_MB,
+                                 multipart_chunksize=1024*1024*MULTIPART_CHUNK_SIZE_MB,
+                                 max_concurrency=TRANSFER_MAX_CONCURRENCY, use_threads=True)
+
+transfer_manager = None
+upload_executor = None
+transfer_lock = threading.Lock()
+
+def get_transfer_manager():
+    global transfer_manager
+    with transfer_lock:
+        if transfer_manager is None:
+            transfer_manager = create_transfer_manager(get_boto_client(), transfer_config)
+    return transfer_manager
+
+def get_upload_executor():
+    # runs whole archive jobs side by side, their parts share the transfer manager
+    global upload_executor
+    with transfer_lock:
+        if upload_executor is None:
+            upload_executor = ThreadPoolExecutor(max_workers=max_concurrent_uploads)
+    return upload_executor
+
+def verify_upload(bucket_name, key, size):
+    resp = get_boto_client().head_object(Bucket=bucket_name, Key=key)
+    if resp['ContentLength'] != size:
+        raise Exception(f'uploaded {bucket_name}/{key} has size {resp["ContentLength"]}, expected {size}')
+
+def upload_archive_file(archive_file, bucket_name, key):
+    size = archive_file.stat().st_size
+    print(f'uploading {archive_file}')
+    # a sha256 of every part is sent along and checked by the server, which
+    # rejects the part if the bytes it got don't match
+    future = get_transfer_manager().upload(str(archive_file), bucket_name, key,
+                                           extra_args={ 'ChecksumAlgorithm': 'SHA256' })
+    future.result()
+    verify_upload(bucket_name, key, size)
+    metrics.uploaded_bytes_total.inc(size, bucket=bucket_name)
+    print(f'uploaded {archive_file} to {bucket_name}/{key}')
+    return size
+
+
+@instrumented('create_pdf_archive')
 def create_pdf_archive(scode, acno, lang):
     ac_pdfs_dir = Path('data/raw/') / f'{scode}' / f'{acno}'
     l_pdfs_dir  = ac_pdfs_dir / f'{lang}' 
@@ -146,6 +327,7 @@ def create_pdf_archive(scode, acno, lang):
 
 
 
+@instrumented('create_archive')
 def create_archive(scode, acno, lang):
     ac_pages_dir = Path('data/pages/') / f'{scode}' / f'{acno}'
     l_pages_dir  = ac_pages_dir / f'{lang}' 
@@ -163,8 +345,7 @@ def create_archive(scode, acno, lang):
         print(f'deleting {l_pages_dir}')
         shutil.rmtree(l_pages_dir)
 
-MULTIPART_CHUNK_SIZE_MB = 100
-
+@instrumented('upload_pdf_archive_to_r2')
 def upload_pdf_archive_to_r2(scode, acno, lang):
     ac_pdfs_dir = Path('data/raw/') / f'{scode}' / f'{acno}'
     archive_file = ac_pdfs_dir / f'{lang}.tar'
@@ -172,17 +353,14 @@ def upload_pdf_archive_to_r2(scode, acno, lang):
     if not archive_file.exists():
         return
        
-    s3 = get_boto_client()
-    config = TransferConfig(multipart_threshold=1024*MULTIPART_CHUNK_SIZE_MB, max_concurrency=10,
-                            multipart_chunksize=1024*MULTIPART_CHUNK_SIZE_MB, use_threads=True)
-
-    print(f'uploading {archive_file}')
-    s3.upload_file(archive_file, 'indian-electoral-rolls-pdfs', f'{scode}/{acno}/{lang}.tar',
-                   Config=config, Callback=ProgressPercentage(archive_file))
+    bucket_name = 'indian-electoral-rolls-pdfs'
+    size = upload_archive_file(archive_file, bucket_name, f'{scode}/{acno}/{lang}.tar')
+    get_manifest().mark_done(bucket_name, scode, acno, lang, size)
 
     print(f'deleting {archive_file}')
     archive_file.unlink()
 
+@instrumented('upload_archive_to_r2')
 def upload_archive_to_r2(scode, acno, lang):
 
     ac_pages_dir = Path('data/pages/') / f'{scode}' / f'{acno}'
@@ -191,18 +369,96 @@ def upload_archive_to_r2(scode, acno, lang):
     if not archive_file.exists():
         return
        
-    s3 = get_boto_client()
-    config = TransferConfig(multipart_threshold=1024*MULTIPART_CHUNK_SIZE_MB, max_concurrency=10,
-                            multipart_chunksize=1024*MULTIPART_CHUNK_SIZE_MB, use_threads=True)
-
-    print(f'uploading {archive_file}')
     bucket_name = 'indian-electoral-rolls'
-    key = f'{scode}/{acno}/{lang}.tar'
-    s3.upload_file(archive_file, bucket_name, key,
-                   Config=config, Callback=ProgressPercentage(archive_file))
+    size = upload_archive_file(archive_file, bucket_name, f'{scode}/{acno}/{lang}.tar')
+    get_manifest().mark_done(bucket_name, scode, acno, lang, size)
 
     print(f'deleting {archive_file}')
     archive_file.unlink()
+    return size
+
+STREAM_PART_SIZE_MB = 16
+
+class MultipartUploadWriter:
+    # write only file object that feeds a multipart upload one part at a
+    # time, so an archive can be built straight into the bucket
+    def __init__(self, s3, bucket_name, key, part_size):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.buf = bytearray()
+        self.parts = []
+        self.size = 0
+        resp = s3.create_multipart_upload(Bucket=bucket_name, Key=key)
+        self.upload_id = resp['UploadId']
+
+    def write(self, data):
+        self.buf.extend(data)
+        while len(self.buf) >= self.part_size:
+            self.upload_part(bytes(self.buf[:self.part_size]))
+            del self.buf[:self.part_size]
+        return len(data)
+
+    def upload_part(self, body):
+        part_number = len(self.parts) + 1
+        # lets the server reject a part that got corrupted on the way
+        content_md5 = base64.b64encode(hashlib.md5(body).digest()).decode()
+        resp = self.s3.upload_part(Bucket=self.bucket_name, Key=self.key,
+                                   PartNumber=part_number, UploadId=self.upload_id,
+                                   Body=body, ContentMD5=content_md5)
+        self.parts.append({ 'ETag': resp['ETag'], 'PartNumber': part_number })
+        self.size += len(body)
+        sys.stdout.write(f'\r{self.key}  {self.size}')
+        sys.stdout.flush()
+
+    def complete(self):
+        if len(self.buf) > 0 or len(self.parts) == 0:
+            self.upload_part(bytes(self.buf))
+            self.buf = bytearray()
+        self.s3.complete_multipart_upload(Bucket=self.bucket_name, Key=self.key,
+                                          UploadId=self.upload_id,
+                                          MultipartUpload={ 'Parts': self.parts })
+        print()
+
+    def abort(self):
+        self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key,
+                                       UploadId=self.upload_id)
+
+
+@instrumented('stream_dir_archive_to_r2')
+def stream_dir_archive_to_r2(src_dir, bucket_name, key):
+    s3 = get_boto_client()
+    print(f'streaming {src_dir} to {bucket_name}/{key}')
+    writer = MultipartUploadWriter(s3, bucket_name, key, 1024*1024*STREAM_PART_SIZE_MB)
+    try:
+        # same member names as 'tar -cvf <archive> <src_dir>' run from the top dir
+        with tarfile.open(fileobj=writer, mode='w|') as tar:
+            tar.add(str(src_dir))
+        writer.complete()
+    except BaseException:
+        writer.abort()
+        raise
+    verify_upload(bucket_name, key, writer.size)
+    metrics.uploaded_bytes_total.inc(writer.size, bucket=bucket_name)
+
+    print(f'deleting {src_dir}')
+    shutil.rmtree(src_dir)
+    return writer.size
+
+def stream_pdf_archive_to_r2(scode, acno, lang):
+    l_pdfs_dir = Path('data/raw/') / f'{scode}' / f'{acno}' / f'{lang}'
+    if not l_pdfs_dir.exists():
+        return
+    size = stream_dir_archive_to_r2(l_pdfs_dir, 'indian-electoral-rolls-pdfs', f'{scode}/{acno}/{lang}.tar')
+    get_manifest().mark_done('indian-electoral-rolls-pdfs', scode, acno, lang, size)
+
+def stream_archive_to_r2(scode, acno, lang):
+    l_pages_dir = Path('data/pages/') / f'{scode}' / f'{acno}' / f'{lang}'
+    if not l_pages_dir.exists():
+        return
+    size = stream_dir_archive_to_r2(l_pages_dir, 'indian-electoral-rolls', f'{scode}/{acno}/{lang}.tar')
+    get_manifest().mark_done('indian-electoral-rolls', scode, acno, lang, size)
 
 def download_pdf_archive_from_r2(scode, acno, lang):
     ac_pdfs_dir = Path('data/raw/') / f'{scode}' / f'{acno}'
@@ -216,14 +472,12 @@ def download_pdf_archive_from_r2(scode, acno, lang):
     key = f'{scode}/{acno}/{lang}.tar'
 
     s3 = get_boto_client()
-    config = TransferConfig(multipart_threshold=1024*MULTIPART_CHUNK_SIZE_MB, max_concurrency=10,
-                            multipart_chunksize=1024*MULTIPART_CHUNK_SIZE_MB, use_threads=True)
     print(f'downloading {archive_file}')
     response = s3.head_object(Bucket=bucket_name, Key=key)
     archive_size = response['ContentLength']
 
     s3.download_file(bucket_name, key, archive_file,
-                     Config=config, Callback=ProgressDownloadPercentage(archive_size))
+                     Config=transfer_config, Callback=ProgressDownloadPercentage(archive_size))
 
 def download_archive_from_r2(scode, acno, lang):
     ac_pages_dir = Path('data/pages/') / f'{scode}' / f'{acno}'
@@ -237,16 +491,44 @@ def download_archive_from_r2(scode, acno, lang):
     key = f'{scode}/{acno}/{lang}.tar'
 
     s3 = get_boto_client()
-    config = TransferConfig(multipart_threshold=1024*MULTIPART_CHUNK_SIZE_MB, max_concurrency=10,
-                            multipart_chunksize=1024*MULTIPART_CHUNK_SIZE_MB, use_threads=True)
     print(f'downloading {archive_file}')
     response = s3.head_object(Bucket=bucket_name, Key=key)
     archive_size = response['ContentLength']
 
     s3.download_file(bucket_name, key, archive_file,
-                     Config=config, Callback=ProgressDownloadPercentage(archive_size))
+                     Config=transfer_config, Callback=ProgressDownloadPercentage(archive_size))
+
+
 
+def stream_pdf_archive_from_r2(scode, acno, lang, on_pdf):
+    # reads the archive body through tarfile as it downloads, each pdf is
+    # handed to on_pdf as soon as it is on disk, no local tar is kept
+    bucket_name = 'indian-electoral-rolls-pdfs'
+    key = f'{scode}/{acno}/{lang}.tar'
 
+    s3 = get_boto_client()
+    print(f'streaming {bucket_name}/{key}')
+    resp = s3.get_object(Bucket=bucket_name, Key=key)
+    with tarfile.open(fileobj=resp['Body'], mode='r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                tar.extract(member, filter='data')
+                continue
+            # rejects absolute paths and the like, same as extract would
+            member = tarfile.data_filter(member, '.')
+            file = Path(member.name)
+            if file.exists():
+                # complete or already converted in an earlier interrupted run,
+                # files only show up under their name once fully written
+                if file.stat().st_size == member.size or file.read_bytes() == b'DONE':
+                    continue
+            file.parent.mkdir(exist_ok=True, parents=True)
+            part_file = file.with_name(file.name + '.part')
+            with tar.extractfile(member) as src, open(part_file, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(part_file, file)
+            if member.name.endswith('.pdf'):
+                on_pdf(file)
 
 def extract_archive(scode, acno, lang):
     ac_pdfs_dir = Path('data/raw/') / f'{scode}' / f'{acno}'
@@ -271,7 +553,7 @@ def get_bucket_keys(bucket_name, with_sizes=False):
     pages = paginator.paginate(Bucket=bucket_name)
 
     for page in pages:
-        for item in page['Contents']:
+        for item in page.get('Contents', []):
             key  = item['Key']
             size = item['Size']
             keys[key] = size
@@ -279,4 +561,12 @@ def get_bucket_keys(bucket_name, with_sizes=False):
         return keys
     return set(keys.keys())
 
-
+def reconcile_manifest(bucket_name, force=False):
+    # a full listing is only needed the first time, or when asked for
+    manifest = get_manifest()
+    if not force and manifest.last_reconciled(bucket_name) is not None:
+        return
+    print(f'reconciling manifest with {bucket_name}')
+    listed_at = time.time()
+    keys = get_bucket_keys(bucket_name, with_sizes=True)
+    manifest.reconcile(bucket_name, keys, listed_at)